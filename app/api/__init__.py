@@ -3,4 +3,4 @@ from flask import Blueprint
 bp = Blueprint('api', __name__)
 
 # 写在最后是为了防止循环导入，ping.py文件也会导入 bp
-from app.api import api_test, login, users, departments, operation
\ No newline at end of file
+from app.api import api_test, login, users, departments, categories, operation, reports, tasks
\ No newline at end of file
@@ -1,20 +1,19 @@
 import logging
 import random
-import uuid
-import os
-from flask import jsonify, session, request, current_app
-from datetime import datetime, timedelta
+import time
+from flask import jsonify, session, request, g
+from datetime import datetime
 from decimal import Decimal
 
-from app.api.tree import Tree
+from app.api.tasks import submit_task
+from app.api.tree import tree_cache
 from app.utils.code import ResponseCode
 from app.utils.response import ResMsg
-from app.utils.util import route, Redis, CaptchaTool, PhoneTool
-from app.utils.auth import Auth, login_required
-from app.api.report import excel_write, word_write, pdf_write
+from app.utils.util import route, Redis, PhoneTool, SmsCodeTool
+from app.utils.captcha import captcha_pool
+from app.utils.auth import Auth, login_required, token_auth
+from app.utils.jobs import ReportJob
 from app.celery import add, flask_app_context
-from elasticsearch import Elasticsearch
-es = Elasticsearch()
 
 from app.api import bp
 
@@ -87,10 +86,10 @@ def test_get_captcha():
     :return:
     """
     res = ResMsg()
-    new_captcha = CaptchaTool()
-    img, code = new_captcha.get_verify_code()
+    # 从验证码池中取出，session中只保存答案哈希和过期时间
+    img, answer_hash = captcha_pool.get()
     res.update(data=img)
-    session["code"] = code
+    session["captcha"] = [answer_hash, time.time() + captcha_pool.ttl]
     return res.data
 
 
@@ -103,12 +102,17 @@ def test_verify_captcha():
     res = ResMsg()
     obj = request.get_json(force=True)
     code = obj.get('code', None)
-    s_code = session.get("code", None)
-    print(code, s_code)
-    if not all([code, s_code]):
+    # 验证码只能使用一次
+    captcha = session.pop("captcha", None)
+    # 答案可能是JSON数字，0 也是合法答案
+    if code is None or not str(code).strip() or not captcha:
         res.update(code=ResponseCode.InvalidParameter)
         return res.data
-    if code != s_code:
+    answer_hash, expire_at = captcha
+    if time.time() > expire_at:
+        res.update(code=ResponseCode.InvalidOrExpired)
+        return res.data
+    if not captcha_pool.verify(code, answer_hash):
         res.update(code=ResponseCode.VerificationCodeError)
         return res.data
     return res.data
@@ -189,65 +193,71 @@ def test_refresh_token():
 # --------------------测试Excel报表输出-------------------------------#
 
 @route(bp, '/testExcel', methods=["GET"])
+@token_auth.login_required
 def test_excel():
     """
     测试excel报表输出
     :return:
     """
     res = ResMsg()
-    report_path = current_app.config.get("REPORT_PATH", "./report")
-    file_name = "{}.xlsx".format(uuid.uuid4().hex)
-    path = os.path.join(report_path, file_name)
-    path = excel_write(path)
-    path = path.lstrip(".")
-    res.update(data=path)
+    # 报表由celery生成，通过 /reports/jobs/<job_id> 查询进度，只有提交者可以查询
+    job = ReportJob.submit("excel", user_id=g.current_user.id)
+    res.update(data=job)
     return res.data
 
 
 # --------------------测试Word报表输出-------------------------------#
 
 @route(bp, '/testWord', methods=["GET"])
+@token_auth.login_required
 def test_word():
     """
     测试word报表输出
     :return:
     """
     res = ResMsg()
-    report_path = current_app.config.get("REPORT_PATH", "./report")
-    file_name = "{}.docx".format(uuid.uuid4().hex)
-    path = os.path.join(report_path, file_name)
-    path = word_write(path)
-    path = path.lstrip(".")
-    res.update(data=path)
+    # 报表由celery生成，通过 /reports/jobs/<job_id> 查询进度，只有提交者可以查询
+    job = ReportJob.submit("word", user_id=g.current_user.id)
+    res.update(data=job)
     return res.data
 
 
 # --------------------测试无限层级目录树-------------------------------#
 
+TEST_TREE_DATA = [
+    {"id": 1, "father_id": None, "name": "01"},
+    {"id": 2, "father_id": 1, "name": "0101"},
+    {"id": 3, "father_id": 1, "name": "0102"},
+    {"id": 4, "father_id": 1, "name": "0103"},
+    {"id": 5, "father_id": 2, "name": "010101"},
+    {"id": 6, "father_id": 2, "name": "010102"},
+    {"id": 7, "father_id": 2, "name": "010103"},
+    {"id": 8, "father_id": 3, "name": "010201"},
+    {"id": 9, "father_id": 4, "name": "010301"},
+    {"id": 10, "father_id": 9, "name": "01030101"},
+    {"id": 11, "father_id": 9, "name": "01030102"},
+]
+
+tree_cache.register('test', lambda: TEST_TREE_DATA)
+
+
 @route(bp, '/testTree', methods=["GET"])
 def test_tree():
     """
     测试无限层级目录树
+    目录树构建后缓存，传入id时返回该节点的子树及祖先节点
     :return:
     """
     res = ResMsg()
-    data = [
-        {"id": 1, "father_id": None, "name": "01"},
-        {"id": 2, "father_id": 1, "name": "0101"},
-        {"id": 3, "father_id": 1, "name": "0102"},
-        {"id": 4, "father_id": 1, "name": "0103"},
-        {"id": 5, "father_id": 2, "name": "010101"},
-        {"id": 6, "father_id": 2, "name": "010102"},
-        {"id": 7, "father_id": 2, "name": "010103"},
-        {"id": 8, "father_id": 3, "name": "010201"},
-        {"id": 9, "father_id": 4, "name": "010301"},
-        {"id": 10, "father_id": 9, "name": "01030101"},
-        {"id": 11, "father_id": 9, "name": "01030102"},
-    ]
-
-    new_tree = Tree(data=data)
-
-    data = new_tree.build_tree()
+    tree = tree_cache.get('test')
+    node_id = request.args.get("id", type=int)
+    if node_id is None:
+        data = tree.tree
+    elif node_id not in tree.nodes:
+        res.update(code=ResponseCode.NoResourceFound)
+        return res.data
+    else:
+        data = dict(node=tree.find(node_id), ancestors=tree.ancestors(node_id), depth=tree.depth(node_id))
 
     res.update(data=data)
     return res.data
@@ -296,7 +306,6 @@ def test_get_verification_code():
     获取手机验证码
     :return:
     """
-    now = datetime.now()
     res = ResMsg()
 
     category = request.args.get("category", None)
@@ -320,27 +329,23 @@ def test_get_verification_code():
         return res.data
 
     try:
-        # 获取手机验证码设置时间
-        flag = Redis.hget(re_phone, 'expire_time')
-        if flag is not None:
-            flag = datetime.strptime(flag, '%Y-%m-%d %H:%M:%S')
-            # 判断是否重复操作
-            if (flag - now).total_seconds() < 60:
-                res.update(code=ResponseCode.FrequentOperation)
-                return res.data
-
         # 获取随机验证码
         code = "".join([str(random.randint(0, 9)) for _ in range(6)])
+        # 检查发送频率并将验证码存入redis，方便接下来的验证
+        result, record = SmsCodeTool.issue(re_phone, request.remote_addr, code)
+        if result != SmsCodeTool.OK:
+            res.update(code=ResponseCode.FrequentOperation)
+            return res.data
+
         template_param = {"code": code}
-        # 发送验证码
-        sms = SendSms(phone=re_phone, category=category, template_param=template_param)
-        sms.send_sms()
-        # 将验证码存入redis，方便接下来的验证
-        Redis.hset(re_phone, "code", code)
-        # 设置重复操作屏障
-        Redis.hset(re_phone, "expire_time", (now + timedelta(minutes=1)).strftime('%Y-%m-%d %H:%M:%S'))
-        # 设置验证码过去时间
-        Redis.expire(re_phone, 60 * 3)
+        try:
+            # 发送验证码
+            sms = SendSms(phone=re_phone, category=category, template_param=template_param)
+            sms.send_sms()
+        except Exception:
+            # 发送失败时作废验证码并撤销发送记录，允许立即重试
+            SmsCodeTool.revoke(re_phone, request.remote_addr, record)
+            raise
         return res.data
     except Exception as e:
         logger.exception(e)
@@ -381,39 +386,41 @@ def test_phone_login_or_register():
 # --------------------测试PDF报表输出-------------------------------#
 
 @route(bp, '/testPDF', methods=["GET"])
+@token_auth.login_required
 def test_pdf():
     """
     测试pdf报表输出
     :return:
     """
     res = ResMsg()
-    report_path = current_app.config.get("REPORT_PATH", "./report")
-    file_name = "{}.pdf".format(uuid.uuid4().hex)
-    path = os.path.join(report_path, file_name)
-    path = pdf_write(path)
-    path = path.lstrip(".")
-    res.update(data=path)
+    # 报表由celery生成，通过 /reports/jobs/<job_id> 查询进度，只有提交者可以查询
+    job = ReportJob.submit("pdf", user_id=g.current_user.id)
+    res.update(data=job)
     return res.data
 
 
 # --------------------测试Celery-------------------------------#
 
 
-@route(bp, '/testCeleryAdd', methods=["GET"])
+@bp.route('/testCeleryAdd', methods=["GET"])
+@token_auth.login_required
 def test_add():
     """
     测试相加
+    提交后立即返回任务ID，通过 /tasks/<task_id> 查询结果，只有提交者可以查询
     :return:
     """
-    result = add.delay(1, 2)
-    return result.get(timeout=1)
+    task = submit_task(add, 1, 2, user_id=g.current_user.id)
+    return ResMsg(data=task).data, 202
 
 
-@route(bp, '/testCeleryFlaskAppContext', methods=["GET"])
+@bp.route('/testCeleryFlaskAppContext', methods=["GET"])
+@token_auth.login_required
 def test_flask_app_context():
     """
     测试获取flask上下文
+    提交后立即返回任务ID，通过 /tasks/<task_id> 查询结果，只有提交者可以查询
     :return:
     """
-    result = flask_app_context.delay()
-    return result.get(timeout=1)
+    task = submit_task(flask_app_context, user_id=g.current_user.id)
+    return ResMsg(data=task).data, 202
@@ -0,0 +1,232 @@
+from flask import request
+from app.api import bp
+from app.api.tree import Tree, tree_cache
+from app.utils.auth import token_auth
+from app.utils.core import db
+from app.utils.code import ResponseCode
+from app.utils.response import ResMsg
+from app.models.model import Category
+
+# 完整的分类树缓存在进程内，增删改时增量更新
+tree_cache.register('categories', lambda: [category.to_node() for category in Category.query.order_by(Category.id)])
+
+
+def build_tree(categories, root_id=None):
+    """
+    分类列表转换为目录树，格式与 Tree.build_tree 相同
+    :param categories: 分类列表
+    :param root_id: 子树根节点ID，作为根节点输出
+    :return:
+    """
+    data = list()
+    for category in categories:
+        node = category.to_node()
+        if node["id"] == root_id:
+            node["father_id"] = None
+        data.append(node)
+    return Tree(data).build_tree()
+
+
+def check_father(father_id):
+    """
+    校验父分类ID，必须为整数或null，且分类存在
+    字符串ID会绕过 Category.move 中的子树检查，所以不做类型转换
+    :return: 错误信息，合法时返回None
+    """
+    if father_id is None:
+        return None
+    if not isinstance(father_id, int) or isinstance(father_id, bool):
+        return 'father_id必须为整数或null'
+    if Category.query.get(father_id) is None:
+        return '父分类不存在'
+    return None
+
+
+@bp.route('/categories/', methods=['POST'])
+@token_auth.login_required
+def create_category():
+    """
+    新建分类
+    ---
+    tags:
+      - 分类相关接口
+    description:
+        新建分类，json格式
+    parameters:
+      - name: body
+        in: body
+        type: object
+        required: true
+        schema:
+          id: 分类
+          required:
+            - name
+          properties:
+            name:
+              type: string
+              description: 分类名字.
+            father_id:
+              type: integer
+              description: 父分类ID, 不传为根分类.
+    responses:
+      200:
+        description:
+    """
+    data = request.get_json()
+    if not data or not data.get('name'):
+        code = ResponseCode.InvalidParameter
+        return ResMsg(code=code, data='You must post JSON data.').data
+    error = check_father(data.get('father_id'))
+    if error:
+        code = ResponseCode.InvalidParameter
+        return ResMsg(code=code, data=error).data
+
+    category = Category.create(data)
+    db.session.commit()
+    tree_cache.insert('categories', category.id, category.father_id, category.name)
+    return ResMsg(data=category.to_dict()).data
+
+
+@bp.route('/categories/', methods=['GET'])
+@token_auth.login_required
+def get_categories():
+    """
+    返回分类树
+    ---
+    tags:
+      - 分类相关接口
+    description:
+        返回完整的分类树，传入depth时只返回根分类向下depth层
+    parameters:
+      - name: depth
+        in: path
+        type: integer
+        description: 层数, 0只返回根分类
+    responses:
+      200:
+        description:
+    """
+    depth = request.args.get('depth', type=int)
+    if depth is None:
+        data = tree_cache.get('categories').tree
+    else:
+        data = build_tree(Category.levels(depth))
+    return ResMsg(data=data).data
+
+
+@bp.route('/categories/<int:id>', methods=['GET'])
+@token_auth.login_required
+def get_category(id):
+    """
+    返回分类及其子树
+    ---
+    tags:
+      - 分类相关接口
+    description:
+        返回分类信息、祖先分类和子树，传入depth时子树只向下depth层
+    parameters:
+      - name: id
+        in: path
+        type: integer
+        description: 分类id
+      - name: depth
+        in: path
+        type: integer
+        description: 子树层数
+    responses:
+      200:
+        description:
+    """
+    category = Category.query.get_or_404(id)
+    depth = request.args.get('depth', type=int)
+    data = category.to_dict()
+    data['ancestors'] = [ancestor.to_dict() for ancestor in Category.ancestors(id)]
+    data['tree'] = build_tree(Category.subtree(id, depth), root_id=id)
+    return ResMsg(data=data).data
+
+
+@bp.route('/categories/<int:id>', methods=['PUT'])
+@token_auth.login_required
+def update_category(id):
+    """
+    修改分类
+    ---
+    tags:
+      - 分类相关接口
+    description:
+        修改分类名字，传入father_id时移动到新的父分类下
+    parameters:
+      - name: id
+        in: path
+        type: integer
+        description: 分类id
+      - name: body
+        in: body
+        type: object
+        required: true
+        schema:
+          id: 分类
+          properties:
+            name:
+              type: string
+              description: 分类名字.
+            father_id:
+              type: integer
+              description: 父分类ID, null为移动为根分类.
+    responses:
+      200:
+        description:
+    """
+    category = Category.query.get_or_404(id)
+    data = request.get_json()
+    if not data:
+        code = ResponseCode.InvalidParameter
+        return ResMsg(code=code, data='You must post JSON data.').data
+
+    moved = 'father_id' in data and data['father_id'] != category.father_id
+    if moved:
+        father_id = data['father_id']
+        error = check_father(father_id)
+        if error:
+            code = ResponseCode.InvalidParameter
+            return ResMsg(code=code, data=error).data
+        try:
+            category.move(father_id)
+        except ValueError as e:
+            db.session.rollback()
+            code = ResponseCode.InvalidParameter
+            return ResMsg(code=code, data=str(e)).data
+    category.from_dict(data)
+    db.session.commit()
+
+    if moved:
+        tree_cache.move('categories', category.id, category.father_id)
+    if 'name' in data:
+        tree_cache.rename('categories', category.id, category.name)
+    return ResMsg(data=category.to_dict()).data
+
+
+@bp.route('/categories/<int:id>', methods=['DELETE'])
+@token_auth.login_required
+def delete_category(id):
+    """
+    删除分类及其所有子分类
+    ---
+    tags:
+      - 分类相关接口
+    description:
+        分类信息接口
+    parameters:
+      - name: id
+        in: path
+        type: integer
+        description: 分类id
+    responses:
+      200:
+        description:
+    """
+    category = Category.query.get_or_404(id)
+    category.delete_subtree()
+    db.session.commit()
+    tree_cache.remove('categories', id)
+    return ResMsg(data='分类删除成功').data
@@ -5,6 +5,7 @@ from flask import request, jsonify, url_for, g, current_app
 from app.api import bp
 from app.utils.auth import token_auth, permission_required, record_operation
 from app.utils.core import db
+from app.utils.cache import user_cache, permission_cache
 from app.utils.code import ResponseCode
 from app.utils.response import ResMsg
 from app.models.model import Department, User
@@ -56,6 +57,7 @@ def create_department():
     department.from_dict(data)
     db.session.add(department)
     db.session.commit()
+    permission_cache.invalidate()
 
     return ResMsg(data='部门创建成功').data
 
@@ -85,6 +87,14 @@ def get_departments():
         in: path
         type: string
         description: 部门创建时间升序(不写) 降序descending
+      - name: cursor
+        in: path
+        type: string
+        description: 游标分页, 第一页传空字符串, 之后使用_links中返回的游标
+      - name: total
+        in: path
+        type: integer
+        description: 游标分页时是否返回总数 1返回
     responses:
       200:
         description: 
@@ -94,7 +104,14 @@ def get_departments():
     per_page = min(
         request.args.get(
             'per_page', current_app.config['DEPARTMENTS_PER_PAGE'], type=int), 100)
+    cursor = request.args.get('cursor')
     query = Department.query
+    if cursor is not None:
+        total = request.args.get('total', 0, type=int)
+        data = Department.to_cursor_dict(query, cursor, per_page, 'api.get_departments', \
+                    descending=timestamp == 'descending', with_total=total, \
+                    timestamp=timestamp, total=total or None)
+        return ResMsg(data=data).data
     if timestamp == 'descending':
         query = query.order_by(Department.timestamp.desc())
     data = Department.to_collection_dict(query, page, per_page, \
@@ -208,6 +225,9 @@ def update_department(id):
 
     department.from_dict(data)
     db.session.commit()
+    permission_cache.invalidate()
+    # 部门信息变更后，使部门成员的认证缓存失效
+    user_cache.invalidate(*[user_id for user_id, in department.members.with_entities(User.id)])
     return ResMsg(data=department.to_dict()).data
 
 @bp.route('/departments/<int:id>', methods=['DELETE'])
@@ -232,6 +252,10 @@ def delete_department(id):
     department = Department.query.get_or_404(id)
     # if g.current_user != user:
     #     return error_response(403)
+    # 部门删除会级联删除成员，先记录成员ID用于清理认证缓存
+    member_ids = [user_id for user_id, in department.members.with_entities(User.id)]
     db.session.delete(department)
     db.session.commit()
+    permission_cache.invalidate()
+    user_cache.invalidate(*member_ids)
     return '', 204
\ No newline at end of file
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from operator import itemgetter
 import re
 from flask import request, jsonify, url_for, g, current_app
@@ -9,6 +9,83 @@ from app.utils.code import ResponseCode
 from app.utils.response import ResMsg
 from app.models.model import Operation, User
 
+DATE_FORMAT = '%Y-%m-%d'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_time(value):
+    """
+    解析日期或时间
+    :param value: 如 2020-05-22 或 2020-05-22 10:00:00
+    :return: (datetime, 是否只有日期)
+    """
+    try:
+        return datetime.strptime(value, TIME_FORMAT), False
+    except ValueError:
+        return datetime.strptime(value, DATE_FORMAT), True
+
+
+# 旧参数 timestamp 是对时间字符串的模糊匹配，补零的时间前缀转换为时间区间: (格式, 区间长度)
+LEGACY_FORMATS = (
+    ('%Y-%m-%d %H:%M:%S', timedelta(seconds=1)),
+    ('%Y-%m-%d %H:%M', timedelta(minutes=1)),
+    ('%Y-%m-%d %H', timedelta(hours=1)),
+    ('%Y-%m-%d', timedelta(days=1)),
+    ('%Y-%m', 'month'),
+    ('%Y', 'year'),
+)
+
+LEGACY_PREFIX = re.compile(r'^\d{4}(-\d{2}(-\d{2}( \d{2}(:\d{2}(:\d{2})?)?)?)?)?$')
+
+
+def legacy_range(timestamp):
+    """
+    将旧参数 timestamp 转换为左闭右开的时间区间
+    :param timestamp: 如 2020、2020-05、2020-05-22、2020-05-22 10:00
+    :return: (start, end)，不是时间前缀(如 05-22)时返回 None，由调用方继续使用模糊匹配
+    """
+    # strptime 也接受不补零的写法，如 2020-05-2 会被当作5月2日，而模糊匹配的是20日到29日，
+    # 所以只转换完整补零的前缀，其他写法保持模糊匹配
+    if not LEGACY_PREFIX.match(timestamp):
+        return None
+    for fmt, step in LEGACY_FORMATS:
+        try:
+            start = datetime.strptime(timestamp, fmt)
+        except ValueError:
+            continue
+        if step == 'year':
+            return start, start.replace(year=start.year + 1)
+        if step == 'month':
+            if start.month == 12:
+                return start, start.replace(year=start.year + 1, month=1)
+            return start, start.replace(month=start.month + 1)
+        return start, start + step
+    return None
+
+
+def time_range(date=None, since=None, until=None):
+    """
+    将日期筛选条件转换为左闭右开的时间区间，用于 timestamp >= start AND timestamp < end
+    :param date: 指定某一天
+    :param since: 开始时间(包含)
+    :param until: 结束时间，只有日期时包含当天，否则不包含
+    :return: (start, end)，没有对应条件时为 None
+    """
+    start = end = None
+    if date:
+        start = datetime.strptime(date, DATE_FORMAT)
+        end = start + timedelta(days=1)
+    if since:
+        value, _ = parse_time(since)
+        start = value if start is None else max(start, value)
+    if until:
+        value, date_only = parse_time(until)
+        if date_only:
+            value += timedelta(days=1)
+        end = value if end is None else min(end, value)
+    return start, end
+
+
 @bp.route('/operation/', methods=['GET'])
 @token_auth.login_required
 @permission_required({"hello":"123"})
@@ -30,14 +107,34 @@ def get_operation():
         in: path
         type: integer
         description: 每页多少个
-      - name: timestamp
+      - name: date
         in: path
         type: string
         description: 日期匹配 日期格式如:2020-05-22
+      - name: timestamp
+        in: path
+        type: string
+        description: 兼容旧参数, 时间前缀如:2020-05、2020-05-22、2020-05-22 10:00, 其他写法按模糊匹配
+      - name: since
+        in: path
+        type: string
+        description: 开始时间(包含) 格式如:2020-05-22 或 2020-05-22 10:00:00
+      - name: until
+        in: path
+        type: string
+        description: 结束时间 格式如:2020-05-22(包含当天) 或 2020-05-22 10:00:00(不包含)
       - name: operator_id
         in: path
         type: integer
         description: 用户id
+      - name: cursor
+        in: path
+        type: string
+        description: 游标分页(按时间倒序), 第一页传空字符串, 之后使用_links中返回的游标
+      - name: total
+        in: path
+        type: integer
+        description: 游标分页时是否返回总数 1返回
     responses:
       200:
         description: 
@@ -47,16 +144,42 @@ def get_operation():
         request.args.get(
             'per_page', current_app.config['DEPARTMENTS_PER_PAGE'], type=int), 100)
     timestamp = request.args.get('timestamp')
+    date = request.args.get('date')
+    since = request.args.get('since')
+    until = request.args.get('until')
     operator_id = request.args.get('operator_id')
-    if timestamp and operator_id:
-        query = Operation.query.filter(Operation.operator_id == operator_id, Operation.timestamp.like("%" + timestamp + "%"))
-    elif not timestamp and operator_id:
-        query = Operation.query.filter(Operation.operator_id == operator_id)
-    elif timestamp and not operator_id:
-        query = Operation.query.filter(Operation.timestamp.like("%" + timestamp + "%"))
-    else:
-        query = Operation.query
-    data = Operation.to_collection_dict(query, page, per_page, 'api.get_operation', timestamp=timestamp, operator_id=operator_id, )
+    try:
+        start, end = time_range(date, since, until)
+    except ValueError:
+        code = ResponseCode.InvalidParameter
+        return ResMsg(code=code, data='Please provide a valid date.').data
+
+    # 使用区间比较而不是字符串匹配，(operator_id, timestamp) 和 timestamp 索引都能用上
+    query = Operation.query
+    if operator_id:
+        query = query.filter(Operation.operator_id == operator_id)
+    if timestamp:
+        legacy = legacy_range(timestamp)
+        if legacy is None:
+            # 无法转换为区间的旧写法保持原来的模糊匹配
+            query = query.filter(Operation.timestamp.like("%" + timestamp + "%"))
+        else:
+            start = legacy[0] if start is None else max(start, legacy[0])
+            end = legacy[1] if end is None else min(end, legacy[1])
+    if start is not None:
+        query = query.filter(Operation.timestamp >= start)
+    if end is not None:
+        query = query.filter(Operation.timestamp < end)
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        # 游标分页按时间倒序，最新的日志在最前面
+        total = request.args.get('total', 0, type=int)
+        data = Operation.to_cursor_dict(query, cursor, per_page, 'api.get_operation', descending=True, \
+                    with_total=total, timestamp=timestamp, date=date, since=since, until=until, \
+                    operator_id=operator_id, total=total or None)
+        return ResMsg(data=data).data
+    data = Operation.to_collection_dict(query, page, per_page, 'api.get_operation', timestamp=timestamp, \
+                    date=date, since=since, until=until, operator_id=operator_id, )
     return ResMsg(data=data).data
 
 # @bp.route('/operation/operators/', methods=['GET'])
@@ -1,16 +1,23 @@
+import io
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from xml.sax.saxutils import escape
 
 import xlsxwriter
+from PyPDF2 import PdfFileReader, PdfFileWriter
 from docx.shared import Mm
-from docxtpl import DocxTemplate, InlineImage
+from docxtpl import InlineImage
 from flask import current_app
 from reportlab.lib.colors import HexColor
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import SimpleDocTemplate, Table, Image, PageBreak, Paragraph
 from reportlab.lib.units import inch
 from reportlab.lib import colors
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+from app.utils.assets import report_assets
+from app.utils.export import export_table
 
 
 def excel_write(path):
@@ -60,8 +67,8 @@ def word_write(generated_doc_path):
     template_path = current_app.config.get("REPORT_TEMPLATES")
     path = os.path.join(template_path, 'test.docx')
 
-    # 读取指定位置的模板文件
-    doc = DocxTemplate(path)
+    # 读取指定位置的模板文件，模板内容已缓存，每次渲染新建模板
+    doc = report_assets.template(path)
     # 渲染的内容
     context = {
         # 标题
@@ -80,7 +87,7 @@ def word_write(generated_doc_path):
         # 页脚
         'footer': '1',
         # 图片
-        'image': InlineImage(doc, os.path.join(template_path, 'test.jpg'), height=Mm(10)),
+        'image': InlineImage(doc, report_assets.image(os.path.join(template_path, 'test.jpg')), height=Mm(10)),
     }
     # 渲染模板
     doc.render(context)
@@ -90,14 +97,15 @@ def word_write(generated_doc_path):
     return generated_doc_path
 
 
-def table_model():
+def table_model(template_path=None):
     """
     添加表格
+    :param template_path: 图片目录，默认为 REPORT_TEMPLATES
     :return:
     """
-    template_path = current_app.config.get("REPORT_TEMPLATES")
+    template_path = template_path or current_app.config.get("REPORT_TEMPLATES")
     image_path = os.path.join(template_path, 'test.jpg')
-    new_img = Image(image_path, width=300, height=300)
+    new_img = Image(report_assets.image(image_path), width=300, height=300)
     base = [
         [new_img, ""],
         ["大类", "小类"],
@@ -157,14 +165,15 @@ def paragraph_model(msg):
     return Paragraph(msg, style=style)
 
 
-def image_model():
+def image_model(template_path=None):
     """
     添加图片
+    :param template_path: 图片目录，默认为 REPORT_TEMPLATES
     :return:
     """
-    template_path = current_app.config.get("REPORT_TEMPLATES")
+    template_path = template_path or current_app.config.get("REPORT_TEMPLATES")
     image_path = os.path.join(template_path, 'test.jpg')
-    new_img = Image(image_path, width=300, height=300)
+    new_img = Image(report_assets.image(image_path), width=300, height=300)
     return new_img
 
 
@@ -176,7 +185,8 @@ def pdf_write(generated_pdf_path):
     # 增加的字体，支持中文显示,需要自行下载支持中文的字体
     font_path = current_app.config.get("SIM_SUN")
 
-    pdfmetrics.registerFont(TTFont('SimSun', os.path.join(font_path, 'SimSun.ttf')))
+    # 字体每个进程只注册一次
+    report_assets.font('SimSun', os.path.join(font_path, 'SimSun.ttf'))
     styles = getSampleStyleSheet()
     styles.add(ParagraphStyle(fontName='SimSun', name='SimSun', leading=20, fontSize=12))
     data = list()
@@ -198,3 +208,169 @@ def pdf_write(generated_pdf_path):
 
     pdf.multiBuild(data)
     return generated_pdf_path
+
+
+# pdf页面大小
+PDF_PAGE_SIZE = (9 * inch, 10 * inch)
+
+
+def pdf_doc(target):
+    """
+    与 pdf_write 相同版式的文档
+    :param target: 文件路径或文件对象
+    :return:
+    """
+    pdf = SimpleDocTemplate(target, rightMargin=0, leftMargin=0, topMargin=40, bottomMargin=0, )
+    pdf.pagesize = PDF_PAGE_SIZE
+    return pdf
+
+
+def default_sections():
+    """
+    与 pdf_write 内容相同的章节
+    :return:
+    """
+    return [
+        {"title": "文字", "blocks": [["paragraph", "测试添加一段文字"]]},
+        {"title": "表格", "blocks": [["table"]]},
+        {"title": "图片", "blocks": [["image"]]},
+    ]
+
+
+def section_flowables(section, template_path=None):
+    """
+    章节内容转换为 reportlab 的 flowable
+    :param section: {"title": 标题, "blocks": [["paragraph", 文字], ["table"], ["image"], ["page_break"]]}
+    :param template_path: 图片目录
+    :return:
+    """
+    flowables = list()
+    for block in section["blocks"]:
+        kind, args = block[0], block[1:]
+        if kind == "paragraph":
+            flowables.append(paragraph_model(*args))
+        elif kind == "table":
+            flowables.append(table_model(template_path))
+        elif kind == "image":
+            flowables.append(image_model(template_path))
+        elif kind == "page_break":
+            flowables.append(PageBreak())
+        else:
+            raise ValueError('未知的pdf内容类型: {}'.format(kind))
+    return flowables
+
+
+def render_section(section, template_path, font_path):
+    """
+    生成单个章节的pdf，在子进程中执行，不依赖flask上下文
+    :return: pdf内容
+    """
+    report_assets.font('SimSun', os.path.join(font_path, 'SimSun.ttf'))
+    buffer = io.BytesIO()
+    pdf_doc(buffer).build(section_flowables(section, template_path))
+    return buffer.getvalue()
+
+
+def render_toc(titles, start_pages):
+    """
+    生成目录
+    :param titles: 章节标题
+    :param start_pages: 章节起始页码
+    :return: pdf内容
+    """
+    title_style = ParagraphStyle(name='SimSunTocTitle', fontName='SimSun', fontSize=24, leading=40)
+    style = ParagraphStyle(name='SimSunToc', fontName='SimSun', fontSize=14, leading=24, leftIndent=40)
+    data = [Paragraph('目录', title_style)]
+    for title, page in zip(titles, start_pages):
+        data.append(Paragraph('{} ........ {}'.format(escape(title), page), style))
+    buffer = io.BytesIO()
+    pdf_doc(buffer).build(data)
+    return buffer.getvalue()
+
+
+def page_number_overlay(total):
+    """
+    生成只有页码的pdf，用于叠加到合并后的每一页
+    :param total: 总页数
+    :return: PdfFileReader
+    """
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=PDF_PAGE_SIZE)
+    for number in range(1, total + 1):
+        c.setFont('SimSun', 10)
+        c.drawCentredString(PDF_PAGE_SIZE[0] / 2, 15, '第 {} 页 / 共 {} 页'.format(number, total))
+        c.showPage()
+    c.save()
+    return PdfFileReader(buffer)
+
+
+def pdf_write_parallel(generated_pdf_path, sections=None, workers=None, toc=True):
+    """
+    分章节并行生成pdf
+    各章节在进程池中独立生成，再合并为一个文件，最后加上目录、页码和书签。
+    celery prefork 的子进程为守护进程，不能再创建进程池，此时按顺序生成各章节。
+    :param generated_pdf_path: 文件路径
+    :param sections: 章节列表，格式见 section_flowables，默认与 pdf_write 内容相同
+    :param workers: 进程数，默认为 REPORT_PDF_WORKERS 或CPU核数
+    :param toc: 是否生成目录
+    :return:
+    """
+    template_path = current_app.config.get("REPORT_TEMPLATES")
+    font_path = current_app.config.get("SIM_SUN")
+    report_assets.font('SimSun', os.path.join(font_path, 'SimSun.ttf'))
+    sections = sections or default_sections()
+    workers = workers or current_app.config.get("REPORT_PDF_WORKERS") or os.cpu_count()
+    args = (sections, repeat(template_path), repeat(font_path))
+
+    parts = None
+    if workers > 1 and len(sections) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(sections))) as executor:
+                parts = list(executor.map(render_section, *args))
+        except AssertionError:
+            parts = None
+    if parts is None:
+        parts = list(map(render_section, *args))
+
+    readers = [PdfFileReader(io.BytesIO(part)) for part in parts]
+    titles = [section.get("title") or "第{}章".format(i + 1) for i, section in enumerate(sections)]
+
+    # 目录页数会影响章节起始页码，页数不再变化时结束
+    toc_pages = 1 if toc else 0
+    while True:
+        start_pages = list()
+        page = toc_pages + 1
+        for reader in readers:
+            start_pages.append(page)
+            page += reader.getNumPages()
+        if not toc:
+            break
+        toc_reader = PdfFileReader(io.BytesIO(render_toc(titles, start_pages)))
+        if toc_reader.getNumPages() == toc_pages:
+            readers.insert(0, toc_reader)
+            break
+        toc_pages = toc_reader.getNumPages()
+
+    pages = [reader.getPage(i) for reader in readers for i in range(reader.getNumPages())]
+    overlay = page_number_overlay(len(pages))
+    writer = PdfFileWriter()
+    for number, page in enumerate(pages):
+        page.mergePage(overlay.getPage(number))
+        writer.addPage(page)
+    for title, start_page in zip(titles, start_pages):
+        writer.addBookmark(title, start_page - 1)
+    with open(generated_pdf_path, 'wb') as f:
+        writer.write(f)
+    return generated_pdf_path
+
+
+# 报表类型: 生成函数，文件后缀见 ReportJob.kinds
+RENDERERS = {
+    'excel': excel_write,
+    'word': word_write,
+    'pdf': pdf_write,
+    # 参数 sections: 章节列表，格式见 section_flowables
+    'pdf_sections': pdf_write_parallel,
+    # 参数 table: users departments operations
+    'export': export_table,
+}
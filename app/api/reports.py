@@ -0,0 +1,113 @@
+import mimetypes
+import os
+from flask import request, send_file, current_app, g
+from app.api import bp
+from app.utils.auth import token_auth, permission_required
+from app.utils.code import ResponseCode
+from app.utils.response import ResMsg
+from app.utils.jobs import ReportJob
+
+
+@bp.route('/reports/<kind>', methods=['POST'])
+@token_auth.login_required
+@permission_required({"hello":"123"})
+def submit_report(kind):
+    """
+    提交报表任务
+    ---
+    tags:
+      - 报表相关接口
+    description:
+        提交报表生成任务，立即返回任务信息，相同的请求会合并到同一个任务
+    parameters:
+      - name: kind
+        in: path
+        type: string
+        description: 报表类型 excel word pdf pdf_sections export
+      - name: body
+        in: body
+        type: object
+        description: 报表参数, export类型需传入table 如{"table":"operations"}, pdf_sections类型可传入sections
+    responses:
+      202:
+        description:
+      400:
+        description: 报表类型未知，或参数不在该类型允许的范围内
+    """
+    if kind not in ReportJob.kinds:
+        code = ResponseCode.InvalidParameter
+        return ResMsg(code=code, data='Unknown report kind.').data, 400
+    params = request.get_json(silent=True) or dict()
+    error = ReportJob.validate(kind, params)
+    if error:
+        code = ResponseCode.InvalidParameter
+        return ResMsg(code=code, data=error).data, 400
+    job = ReportJob.submit(kind, params, g.current_user.id)
+    return ResMsg(data=job).data, 202
+
+
+@bp.route('/reports/jobs/<job_id>', methods=['GET'])
+@token_auth.login_required
+@permission_required({"hello":"123"})
+def get_report_job(job_id):
+    """
+    查询报表任务状态
+    ---
+    tags:
+      - 报表相关接口
+    description:
+        返回任务状态 pending running done failed 及进度
+    parameters:
+      - name: job_id
+        in: path
+        type: string
+        description: 任务ID
+    responses:
+      200:
+        description:
+    """
+    job = ReportJob.get(job_id)
+    # 只能查看自己提交的任务
+    if job is None or not ReportJob.owned_by(job_id, g.current_user.id):
+        code = ResponseCode.NoResourceFound
+        return ResMsg(code=code).data
+    return ResMsg(data=job).data
+
+
+@bp.route('/reports/jobs/<job_id>/file', methods=['GET'])
+@token_auth.login_required
+@permission_required({"hello":"123"})
+def get_report_file(job_id):
+    """
+    下载报表文件
+    ---
+    tags:
+      - 报表相关接口
+    description:
+        任务完成后返回报表文件
+    parameters:
+      - name: job_id
+        in: path
+        type: string
+        description: 任务ID
+    responses:
+      200:
+        description:
+    """
+    job = ReportJob.get(job_id)
+    if job is None or not ReportJob.owned_by(job_id, g.current_user.id):
+        code = ResponseCode.NoResourceFound
+        return ResMsg(code=code).data
+    if job['status'] != 'done' or not os.path.exists(job['path']):
+        code = ResponseCode.NoResourceFound
+        return ResMsg(code=code, data=job).data
+    file_name = os.path.basename(job['path'])
+    accel_prefix = current_app.config.get('REPORT_X_ACCEL_PREFIX')
+    if accel_prefix:
+        # 由nginx的internal location直接发送文件，python不读取文件内容
+        response = current_app.response_class(mimetype=mimetypes.guess_type(file_name)[0])
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + file_name
+        response.headers['Content-Disposition'] = 'attachment; filename={}'.format(file_name)
+        return response
+    # 配置 USE_X_SENDFILE 时由 send_file 返回 X-Sendfile 头
+    return send_file(os.path.abspath(job['path']), as_attachment=True)
@@ -0,0 +1,159 @@
+import time
+from celery import states
+from celery.result import AsyncResult
+from flask import request, current_app, url_for, Response, stream_with_context, json, g
+from app.api import bp
+from app.celery import celery_app
+from app.utils.auth import token_auth
+from app.utils.code import ResponseCode
+from app.utils.response import ResMsg
+from app.utils.util import Redis
+
+# 已提交的任务ID: 任务名，用于区分不存在的任务和等待中的任务(两者在celery中都是PENDING)
+TASK_PREFIX = 'celery_task:'
+# 任务ID: 提交用户ID，只有提交者可以查询任务状态和结果
+TASK_OWNER_PREFIX = 'celery_task_owner:'
+
+
+def submit_task(task, *args, user_id=None, **kwargs):
+    """
+    提交celery任务，立即返回，不等待结果
+    :param task: celery任务
+    :param user_id: 提交用户，只有该用户可以查询任务
+    :return: 任务信息，包含查询状态的链接
+    """
+    result = task.apply_async(args=args, kwargs=kwargs)
+    expire = current_app.config.get('TASK_STATUS_EXPIRE', 86400)
+    with Redis.pipeline() as pipe:
+        pipe.set(TASK_PREFIX + result.id, task.name, ex=expire)
+        if user_id is not None:
+            pipe.set(TASK_OWNER_PREFIX + result.id, user_id, ex=expire)
+        pipe.execute()
+    return dict(task_id=result.id,
+                name=task.name,
+                state=states.PENDING,
+                ready=False,
+                status_url=url_for('api.get_task', task_id=result.id),
+                events_url=url_for('api.get_task_events', task_id=result.id))
+
+
+def task_name(task_id):
+    """
+    当前用户提交的任务的任务名，任务不存在或不是当前用户提交时返回None
+    """
+    name = Redis.read(TASK_PREFIX + task_id)
+    if name is None or Redis.read(TASK_OWNER_PREFIX + task_id) != str(g.current_user.id):
+        return None
+    return name
+
+
+def task_status(task_id, name):
+    """
+    从结果后端读取任务状态，不订阅、不阻塞
+    :param task_id: 任务ID
+    :param name: 任务名
+    :return:
+    """
+    result = AsyncResult(task_id, app=celery_app)
+    state = result.state
+    data = dict(task_id=task_id, name=name, state=state, ready=state in states.READY_STATES)
+    if state == states.SUCCESS:
+        data['result'] = result.result
+    elif state in states.PROPAGATE_STATES:
+        data['error'] = repr(result.result)
+    elif isinstance(result.info, dict):
+        # 任务通过 update_state 上报的进度
+        data['meta'] = result.info
+    return data
+
+
+@bp.route('/tasks/<task_id>', methods=['GET'])
+@token_auth.login_required
+def get_task(task_id):
+    """
+    查询celery任务状态
+    ---
+    tags:
+      - 任务相关接口
+    description:
+        返回任务状态 PENDING STARTED SUCCESS FAILURE 等，完成后返回结果。传入wait时为长轮询，
+        任务完成或等待超时后返回
+    parameters:
+      - name: task_id
+        in: path
+        type: string
+        description: 任务ID
+      - name: wait
+        in: path
+        type: number
+        description: 最长等待秒数，不超过 TASK_LONG_POLL_MAX
+    responses:
+      200:
+        description:
+    """
+    name = task_name(task_id)
+    if name is None:
+        code = ResponseCode.NoResourceFound
+        return ResMsg(code=code).data
+    config = current_app.config
+    wait = min(request.args.get('wait', 0, type=float), config.get('TASK_LONG_POLL_MAX', 25))
+    interval = config.get('TASK_POLL_INTERVAL', 0.5)
+    deadline = time.monotonic() + wait
+    data = task_status(task_id, name)
+    while not data['ready'] and time.monotonic() < deadline:
+        time.sleep(interval)
+        data = task_status(task_id, name)
+    return ResMsg(data=data).data
+
+
+@bp.route('/tasks/<task_id>/events', methods=['GET'])
+@token_auth.login_required
+def get_task_events(task_id):
+    """
+    以server-sent events推送celery任务状态
+    ---
+    tags:
+      - 任务相关接口
+    description:
+        状态变化时推送 status 事件，任务完成或超过 TASK_EVENTS_MAX 秒后结束
+    parameters:
+      - name: task_id
+        in: path
+        type: string
+        description: 任务ID
+    responses:
+      200:
+        description:
+    """
+    name = task_name(task_id)
+    if name is None:
+        code = ResponseCode.NoResourceFound
+        return ResMsg(code=code).data
+    config = current_app.config
+    interval = config.get('TASK_POLL_INTERVAL', 0.5)
+    heartbeat = config.get('TASK_EVENTS_HEARTBEAT', 15)
+    deadline = time.monotonic() + config.get('TASK_EVENTS_MAX', 300)
+
+    def events():
+        last = None
+        sent_at = time.monotonic()
+        while True:
+            data = task_status(task_id, name)
+            now = time.monotonic()
+            if data != last:
+                yield 'event: status\ndata: {}\n\n'.format(json.dumps(data))
+                last = data
+                sent_at = now
+            elif now - sent_at >= heartbeat:
+                # 注释行，防止代理断开空闲连接
+                yield ': keep-alive\n\n'
+                sent_at = now
+            if data['ready'] or now >= deadline:
+                return
+            time.sleep(interval)
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # 关闭nginx对该响应的缓冲
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
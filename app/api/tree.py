@@ -1,67 +1,311 @@
+import logging
+import threading
+import time
+
+import redis
+
+from app.utils.util import Redis
+
+logger = logging.getLogger(__name__)
+
+
+class Node(object):
+    """
+    目录树节点
+    view 为节点对外输出的字典 {name, id, child}，child 与 children 同步维护，
+    输出整棵树时无需再复制节点。tin/tout 为先序遍历的进入/离开序号，
+    节点 b 在 a 的子树中当且仅当 a.tin <= b.tin <= a.tout。
+    """
+    __slots__ = ('id', 'name', 'father_id', 'children', 'view', 'tin', 'tout', 'depth')
+
+    def __init__(self, id, name, father_id=None):
+        self.id = id
+        self.name = name
+        self.father_id = father_id
+        self.children = list()
+        self.view = dict(name=name, id=id, child=list())
+        self.tin = None
+        self.tout = None
+        self.depth = 0
+
+    def append(self, node):
+        self.children.append(node)
+        self.view["child"].append(node.view)
+
+    def detach(self, node):
+        self.children.remove(node)
+        self.view["child"].remove(node.view)
+
+
 class Tree(object):
+    """
+    无限层级目录树
+    单次遍历建立节点，迭代方式编号，不受递归深度限制。
+    father_id 为 None 的节点为根节点，父节点不存在或成环的节点不在树中。
+    """
+
     def __init__(self, data):
         self.data = data
-        self.root_node = list()
-        self.common_node = dict()
+        # id: Node
+        self.nodes = dict()
+        self.roots = list()
+        # 先序遍历顺序的节点ID，子树为其中连续的一段
+        self.order = list()
         self.tree = list()
+        self._indexed = False
+
+    def build_tree(self) -> list:
+        """
+        生成目录树
+        :return: [{name, id, child: [...]}, ...]
+        """
+        nodes = dict()
+        for item in self.data:
+            nodes[item["id"]] = Node(item["id"], item["name"], item.get("father_id"))
+        for node in nodes.values():
+            if node.father_id is None:
+                self.roots.append(node)
+                self.tree.append(node.view)
+            elif node.father_id in nodes:
+                nodes[node.father_id].append(node)
+        self.nodes = nodes
+        self._index()
+        # 去掉从根节点不可达的节点
+        if len(self.order) != len(nodes):
+            self.nodes = {node_id: nodes[node_id] for node_id in self.order}
+        return self.tree
 
-    def find_root_node(self, ) -> list:
+    def _index(self):
         """
-        查找根节点
-        :return:根节点列表
+        迭代先序遍历，计算 tin/tout/depth
         """
-        # self.root_node = list(filter(lambda x: x["father_id"] is None, data))
-        for node in self.data:
-            # 假定father_id是None就是根节点，例如有些数据库设计会直接把根节点标识出来。
-            if node["father_id"] is None:
-                self.root_node.append(node)
-        return self.root_node
+        order = list()
+        stack = [(root, False) for root in reversed(self.roots)]
+        for root in self.roots:
+            root.depth = 0
+        while stack:
+            node, leaving = stack.pop()
+            if leaving:
+                node.tout = len(order) - 1
+                continue
+            node.tin = len(order)
+            order.append(node.id)
+            stack.append((node, True))
+            for child in reversed(node.children):
+                child.depth = node.depth + 1
+                stack.append((child, False))
+        self.order = order
+        self._indexed = True
 
-    def find_common_node(self) -> dict:
+    def node(self, node_id) -> Node:
         """
-        寻找共同的父节点
-        :return: 共同的父节点字典
+        获取节点，编号在修改后按需重新计算
         """
+        if node_id not in self.nodes:
+            raise KeyError(node_id)
+        if not self._indexed:
+            self._index()
+        return self.nodes[node_id]
 
-        for node in self.data:
-            father_id = node.get("father_id")
-            # 排除根节点情况
-            if father_id is not None:
-                # 如果父节点ID不在字典中则添加到字典中
-                if father_id not in self.common_node:
-                    self.common_node[father_id] = list()
-                self.common_node[father_id].append(node)
-        return self.common_node
+    def find(self, node_id) -> dict:
+        """
+        以指定节点为根的子树
+        """
+        return self.node(node_id).view
 
-    def build_tree(self, ) -> list:
+    def subtree(self, node_id) -> list:
         """
-        生成目录树
-        :return:
-        """
-        self.find_root_node()
-        self.find_common_node()
-        for root in self.root_node:
-            # 生成字典
-            base = dict(name=root["name"], id=root["id"], child=list())
-            # 遍历查询子节点
-            self.find_child(base["id"], base["child"])
-            # 添加到列表
-            self.tree.append(base)
-        return self.tree
+        节点及其所有子孙节点的ID
+        """
+        node = self.node(node_id)
+        return self.order[node.tin:node.tout + 1]
+
+    def ancestors(self, node_id) -> list:
+        """
+        从根节点到父节点的ID
+        """
+        result = list()
+        father_id = self.node(node_id).father_id
+        while father_id is not None:
+            result.append(father_id)
+            father_id = self.nodes[father_id].father_id
+        result.reverse()
+        return result
+
+    def is_ancestor(self, ancestor_id, node_id) -> bool:
+        """
+        ancestor_id 是否为 node_id 本身或其祖先
+        """
+        ancestor = self.node(ancestor_id)
+        node = self.node(node_id)
+        return ancestor.tin <= node.tin <= ancestor.tout
+
+    def depth(self, node_id) -> int:
+        return self.node(node_id).depth
+
+    def _attach(self, node):
+        if node.father_id is None:
+            self.roots.append(node)
+            self.tree.append(node.view)
+        else:
+            self.nodes[node.father_id].append(node)
+
+    def _detach(self, node):
+        if node.father_id is None:
+            self.roots.remove(node)
+            self.tree.remove(node.view)
+        else:
+            self.nodes[node.father_id].detach(node)
+
+    def insert(self, node_id, father_id, name):
+        """
+        新增节点
+        """
+        if node_id in self.nodes:
+            raise ValueError('节点已存在: {}'.format(node_id))
+        if father_id is not None and father_id not in self.nodes:
+            raise ValueError('父节点不存在: {}'.format(father_id))
+        node = Node(node_id, name, father_id)
+        self.nodes[node_id] = node
+        self._attach(node)
+        self._indexed = False
+        return node
+
+    def move(self, node_id, father_id):
+        """
+        移动节点(连同子树)到新的父节点下
+        """
+        node = self.node(node_id)
+        if father_id is not None:
+            if father_id not in self.nodes:
+                raise ValueError('父节点不存在: {}'.format(father_id))
+            if self.is_ancestor(node_id, father_id):
+                raise ValueError('不能移动到自身或子节点下: {}'.format(node_id))
+        self._detach(node)
+        node.father_id = father_id
+        self._attach(node)
+        self._indexed = False
+        return node
+
+    def rename(self, node_id, name):
+        node = self.node(node_id)
+        node.name = name
+        node.view["name"] = name
+        return node
+
+    def remove(self, node_id):
+        """
+        删除节点及其子树
+        """
+        for child_id in self.subtree(node_id):
+            node = self.nodes.pop(child_id)
+            if child_id == node_id:
+                self._detach(node)
+        self._indexed = False
+
+
+class TreeCache(object):
+    """
+    目录树缓存
+    按名称缓存构建好的 Tree，版本号存放在Redis的 tree:version:<name> 中。
+    数据修改后调用 insert/move/rename/remove 在本进程的树上增量修改并递增版本号；
+    其他worker每隔 TREE_CACHE_CHECK_INTERVAL 秒比对一次版本号，不一致时重新加载。
+    """
+    version_prefix = 'tree:version:'
+
+    def __init__(self, app=None):
+        self.check_interval = 1
+        # name: 返回 [{id, father_id, name}, ...] 的函数
+        self._loaders = dict()
+        # name: [version, Tree]
+        self._trees = dict()
+        self._checked_at = dict()
+        self._lock = threading.RLock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.check_interval = app.config.get('TREE_CACHE_CHECK_INTERVAL', 1)
+
+    def register(self, name, loader):
+        """
+        注册目录树
+        :param name: 名称
+        :param loader: 加载数据的函数
+        """
+        self._loaders[name] = loader
+
+    def _read_version(self, name):
+        try:
+            return int(Redis.read(self.version_prefix + name) or 0)
+        except redis.RedisError as e:
+            logger.warning("读取目录树版本号失败: %s", e)
+            return None
+
+    def get(self, name) -> Tree:
+        """
+        获取构建好的目录树
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._trees.get(name)
+            if item is not None and now - self._checked_at.get(name, 0) >= self.check_interval:
+                self._checked_at[name] = now
+                version = self._read_version(name)
+                if version is not None and version != item[0]:
+                    item = None
+            if item is None:
+                version = self._read_version(name)
+                tree = Tree(self._loaders[name]())
+                tree.build_tree()
+                item = [version, tree]
+                self._trees[name] = item
+                self._checked_at[name] = now
+            return item[1]
+
+    def _apply(self, name, operation, *args):
+        with self._lock:
+            item = self._trees.get(name)
+            if item is not None:
+                try:
+                    getattr(item[1], operation)(*args)
+                except (KeyError, ValueError) as e:
+                    # 本地树与数据库不一致，下次访问时重新加载
+                    logger.warning("目录树 %s 增量更新失败: %s", name, e)
+                    item = None
+            try:
+                version = Redis.incr(self.version_prefix + name)
+            except redis.RedisError as e:
+                logger.warning("更新目录树版本号失败: %s", e)
+                return
+            # 期间有其他worker修改过，本地树缺少这些修改
+            if item is None or item[0] is None or version != item[0] + 1:
+                self._trees.pop(name, None)
+            else:
+                item[0] = version
+
+    def insert(self, name, node_id, father_id, node_name):
+        self._apply(name, 'insert', node_id, father_id, node_name)
+
+    def move(self, name, node_id, father_id):
+        self._apply(name, 'move', node_id, father_id)
+
+    def rename(self, name, node_id, node_name):
+        self._apply(name, 'rename', node_id, node_name)
+
+    def remove(self, name, node_id):
+        self._apply(name, 'remove', node_id)
+
+    def invalidate(self, name):
+        """
+        使所有worker的目录树失效
+        """
+        with self._lock:
+            self._trees.pop(name, None)
+            try:
+                Redis.incr(self.version_prefix + name)
+            except redis.RedisError as e:
+                logger.warning("更新目录树版本号失败: %s", e)
+
 
-    def find_child(self, father_id: int, child_node: list):
-        """
-        查找子节点
-        :param father_id:父级ID
-        :param child_node: 父级孩子节点
-        :return:
-        """
-        # 获取共同父节点字典的子节点数据
-        child_list = self.common_node.get(father_id, [])
-        for item in child_list:
-            # 生成字典
-            base = dict(name=item["name"], id=item["id"], child=list())
-            # 遍历查询子节点
-            self.find_child(item["id"], base["child"])
-            # 添加到列表
-            child_node.append(base)
+tree_cache = TreeCache()
@@ -5,6 +5,8 @@ from flask import request, jsonify, url_for, g, current_app
 from app.api import bp
 from app.utils.auth import token_auth
 from app.utils.core import db
+from app.utils.cache import user_cache
+from app.utils.search import user_search
 from app.utils.code import ResponseCode
 from app.utils.response import ResMsg
 from app.models.model import User
@@ -93,6 +95,10 @@ def get_users():
         in: path
         type: string
         description: 用户名字 模糊匹配
+      - name: q
+        in: path
+        type: string
+        description: 搜索用户账号或名字 按相关度排序
       - name: department_id
         in: path
         type: integer
@@ -101,6 +107,14 @@ def get_users():
         in: path
         type: string
         description: 用户创建时间升序(不写) 降序descending 
+      - name: cursor
+        in: path
+        type: string
+        description: 游标分页, 第一页传空字符串, 之后使用_links中返回的游标, 按id排序, 不能与q同时使用
+      - name: total
+        in: path
+        type: integer
+        description: 游标分页时是否返回总数 1返回
     responses:
       200:
         description: 
@@ -113,7 +127,16 @@ def get_users():
     name = request.args.get('name')
     department_id = request.args.get('department_id')
     member_since = request.args.get('member_since')
+    q = request.args.get('q')
+    cursor = request.args.get('cursor')
+    if q and cursor is not None:
+        # 游标分页按 id 排序，会丢掉搜索的相关度排序
+        code = ResponseCode.InvalidParameter
+        return ResMsg(code=code, data='q cannot be used with cursor.').data, 400
     query = User.query
+    if q:
+        # 全文索引搜索账号和名字，按相关度排序
+        query = user_search.apply(query, q)
     if username and name:
         query = query.filter(User.username.like("%" + username + "%"),\
                             User.name.like("%" + name + "%"))
@@ -124,12 +147,21 @@ def get_users():
     if department_id:
         query = query.filter(User.department_id == department_id)
     
+    if cursor is not None:
+        # 游标分页按 id 排序，id 与创建时间顺序一致
+        total = request.args.get('total', 0, type=int)
+        data = User.to_cursor_dict(query, cursor, per_page, 'api.get_users', \
+                descending=member_since == 'descending', with_total=total, \
+                username=username, name=name, department_id=department_id, \
+                member_since=member_since, total=total or None)
+        return ResMsg(data=data).data
+
     if member_since == 'descending':
         query = query.order_by(User.member_since.desc())
 
     data = User.to_collection_dict(query, page, per_page, \
             'api.get_users', username=username, name=name, \
-                department_id=department_id, member_since=member_since)
+                department_id=department_id, member_since=member_since, q=q)
     return ResMsg(data=data).data
 
 
@@ -235,6 +267,7 @@ def update_user(id):
 
     user.from_dict(data, new_user=False)
     db.session.commit()
+    user_cache.invalidate(user.id)
     return ResMsg(data=user.to_dict()).data
 
 @bp.route('/users/<int:id>', methods=['DELETE'])
@@ -261,6 +294,7 @@ def delete_user(id):
     #     return error_response(403)
     db.session.delete(user)
     db.session.commit()
+    user_cache.invalidate(id)
     return '', 204
 
 
@@ -382,6 +416,7 @@ def get_followers(id):
     # 将新粉丝通知的计数归零
     user.add_notification('unread_follows_count', 0)
     db.session.commit()
+    user_cache.invalidate(user.id)
     return jsonify(data)
 
 
@@ -442,6 +477,7 @@ def get_user_followeds_posts(id):
     # 将新文章通知的计数归零
     user.add_notification('unread_followeds_posts_count', 0)
     db.session.commit()
+    user_cache.invalidate(user.id)
     return jsonify(data)
 
 
@@ -498,6 +534,7 @@ def get_user_recived_comments(id):
     # 将新评论通知的计数归零
     user.add_notification('unread_recived_comments_count', 0)
     db.session.commit()
+    user_cache.invalidate(user.id)
     return jsonify(data)
 
 
@@ -551,6 +588,7 @@ def get_user_recived_comments_likes(id):
     # 将新点赞通知的计数归零
     user.add_notification('unread_comments_likes_count', 0)
     db.session.commit()
+    user_cache.invalidate(user.id)
     return jsonify(records)
 
 
@@ -604,6 +642,7 @@ def get_user_recived_posts_likes(id):
     # 将新喜欢通知的计数归零
     user.add_notification('unread_posts_likes_count', 0)
     db.session.commit()
+    user_cache.invalidate(user.id)
     return jsonify(records)
 
 
@@ -714,6 +753,7 @@ def get_user_history_messages(id):
         # 更新用户的新私信通知的计数
         user.add_notification('unread_messages_count', user.new_recived_messages())
         db.session.commit()
+        user_cache.invalidate(user.id)
     # 最后，重新组合 data['items']，因为收到的新私信添加了 is_new 标记
     messages = recived_messages + sent_messages
     messages.sort(key=data['items'].index)  # 保持 messages 列表元素的顺序跟 data['items'] 一样
@@ -810,6 +850,7 @@ def confirm(token):
     if g.current_user.verify_confirm_jwt(token):
         g.current_user.ping()
         db.session.commit()
+        user_cache.invalidate(g.current_user.id)
         # 给用户发放新 JWT，因为要包含 confirmed: true
         token = g.current_user.get_jwt()
         return jsonify({
@@ -886,6 +927,7 @@ def reset_password(token):
         return bad_request('The reset password link is invalid or has expired.')
     user.set_password(data.get('password'))
     db.session.commit()
+    user_cache.invalidate(user.id)
     return jsonify({
         'status': 'success',
         'message': 'Your password has been reset.'
@@ -906,11 +948,13 @@ def update_password():
         return bad_request('Please provide a valid new password.')
     if data.get('old_password') == data.get('new_password'):
         return bad_request('The new password is equal to the old password.')
-    # 验证旧密码
+    # 验证旧密码，缓存的用户不包含密码哈希，从数据库读取
+    db.session.refresh(g.current_user, ['password_hash'])
     if not g.current_user.check_password(data.get('old_password')):
         return bad_request('The old password is wrong.')
     g.current_user.set_password(data.get('new_password'))
     db.session.commit()
+    user_cache.invalidate(g.current_user.id)
     return jsonify({
         'status': 'success',
         'message': 'Your password has been updated.'
@@ -1,7 +1,70 @@
-from celery import Celery
+import json
+import logging
+import os
+
+from celery import Celery, Task
+from celery.signals import worker_process_init
 from flask import current_app
 
-celery_app = Celery(__name__)
+from app.utils.core import db
+
+logger = logging.getLogger(__name__)
+
+
+class ContextTask(Task):
+    """
+    在flask应用上下文中执行的任务
+    flask应用由 create_app 调用 init_celery 注册，每个worker进程只创建一次，
+    数据库连接池和Redis连接池在任务之间复用。未注册时(例如 celery -A app.celery 启动)按
+    环境变量 FLASK_CONFIG 创建。每个任务使用独立的应用上下文，结束时归还数据库连接。
+    """
+
+    def __call__(self, *args, **kwargs):
+        with get_flask_app().app_context():
+            return super(ContextTask, self).__call__(*args, **kwargs)
+
+
+celery_app = Celery(__name__, task_cls=ContextTask)
+celery_app.flask_app = None
+
+
+def init_celery(app):
+    """
+    注册flask应用并更新celery配置
+    :param app: flask应用
+    :return:
+    """
+    config = app.config
+    broker = "redis://{}:{}/{}".format(config['REDIS_HOST'], config['REDIS_PORT'], config['REDIS_DB'])
+    celery_app.conf.update({
+        "broker_url": broker,
+        "result_backend": broker,
+        "result_expires": config.get('TASK_STATUS_EXPIRE', 86400),
+        # 每个子进程只预取一个任务，长任务不会压住其他任务
+        "worker_prefetch_multiplier": config.get('CELERY_PREFETCH_MULTIPLIER', 1),
+        # 任务执行完才确认，worker异常退出时任务重新投递
+        "task_acks_late": config.get('CELERY_ACKS_LATE', True),
+        "task_reject_on_worker_lost": config.get('CELERY_ACKS_LATE', True),
+    })
+    celery_app.flask_app = app
+
+
+def get_flask_app():
+    if celery_app.flask_app is None:
+        # 写在函数内是为了防止循环导入
+        from app.factory import create_app
+        create_app(os.environ.get('FLASK_CONFIG', 'PRODUCTION'))
+    return celery_app.flask_app
+
+
+@worker_process_init.connect
+def dispose_engine(**kwargs):
+    """
+    prefork子进程丢弃从父进程继承的数据库连接，各自建立连接池
+    """
+    if celery_app.flask_app is not None:
+        with celery_app.flask_app.app_context():
+            db.engine.dispose()
 
 
 @celery_app.task
@@ -21,5 +84,54 @@ def flask_app_context():
     celery使用Flask上下文
     :return:
     """
-    with current_app.app_context():
-        return str(current_app.config)
+    return str(current_app.config)
+
+
+@celery_app.task
+def render_report(job_id):
+    """
+    生成报表，进度和结果写入任务状态
+    :param job_id: 任务ID
+    :return:
+    """
+    # 写在函数内是为了避免web进程导入报表相关的依赖
+    from app.api.report import RENDERERS
+    from app.utils.jobs import ReportJob
+
+    job = ReportJob.get(job_id)
+    if job is None:
+        return
+    render = RENDERERS[job['kind']]
+    ReportJob.update(job_id, status='running', progress=10)
+    path = ReportJob.report_path(job_id, job['kind'])
+    # 先写入临时文件，生成完成后再改名，避免返回写了一半的文件
+    part_path = path + '.part'
+    try:
+        # 只传入该类型允许的参数，提交时已校验
+        params = {key: value for key, value in job['params'].items() if key in ReportJob.params[job['kind']]}
+        result = render(part_path, **params)
+        os.replace(part_path, path)
+    except Exception as e:
+        logger.exception(e)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        ReportJob.update(job_id, status='failed', error=str(e))
+        return
+    fields = dict(status='done', progress=100, path=path, url=path.lstrip("."))
+    # 导出类报表会返回行数、耗时、内存等统计
+    if isinstance(result, dict):
+        fields['stats'] = json.dumps(result)
+    ReportJob.update(job_id, **fields)
+
+
+@celery_app.task(ignore_result=True)
+def refill_captcha_pool():
+    """
+    补满图形验证码池
+    :return:
+    """
+    # 写在函数内是为了防止循环导入
+    from app.utils.captcha import captcha_pool
+
+    added = captcha_pool.refill()
+    logger.info("验证码池补充 %s 张", added)
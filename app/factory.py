@@ -6,12 +6,20 @@ import yaml
 import os
 from flask import Flask, Blueprint
 from flasgger import Swagger
-from app.celery import celery_app
+from app.celery import init_celery
 
 from app.utils.core import JSONEncoder, db, scheduler
 from flask_migrate import Migrate, MigrateCommand
 from app.api import bp as api_bp
-from app.utils.email import mail
+from app.api.tree import tree_cache
+from app.utils.email import mail, mail_dispatcher, attachment_store
+from app.utils.util import Redis
+from app.utils.response import messages
+from app.utils.cache import user_cache, permission_cache
+from app.utils.last_seen import last_seen_tracker
+from app.utils.audit import audit_log
+from app.utils.search import user_search
+from app.utils.captcha import captcha_pool
 migrate = Migrate()
 
 def create_app(config_name, config_path=None):
@@ -34,9 +42,8 @@ def create_app(config_name, config_path=None):
     swagger_config['host'] = app.config["SWAGGER_HOST"]    # 请求域名
     Swagger(app, config=swagger_config)
 
-    # 更新Celery配置信息
-    celery_conf = "redis://{}:{}/{}".format(app.config['REDIS_HOST'], app.config['REDIS_PORT'], app.config['REDIS_DB'])
-    celery_app.conf.update({"broker_url": celery_conf, "result_backend": celery_conf})
+    # 更新Celery配置信息，任务在该应用的上下文中执行
+    init_celery(app)
 
     # 注册接口
     # register_api(app=app, routers=router)
@@ -51,7 +58,26 @@ def create_app(config_name, config_path=None):
     migrate.init_app(app, db)
 
     # 注册邮件功能
-    mail.init_app(app) 
+    mail.init_app(app)
+    mail_dispatcher.init_app(app)
+    attachment_store.init_app(app)
+
+    # Redis连接池
+    Redis.init_app(app)
+
+    # 认证用户缓存
+    user_cache.init_app(app)
+    permission_cache.init_app(app)
+    tree_cache.init_app(app)
+
+    # 用户最后访问时间记录
+    last_seen_tracker.init_app(app)
+
+    # 操作日志异步写入
+    audit_log.init_app(app)
+
+    # 图形验证码池
+    captcha_pool.init_app(app)
        
     # 启动定时任务
     if app.config.get("SCHEDULER_OPEN"):
@@ -70,10 +96,11 @@ def create_app(config_name, config_path=None):
         dict_conf = yaml.safe_load(f.read())
     logging.config.dictConfig(dict_conf)
 
-    # 读取msg配置
-    with open(app.config['RESPONSE_MESSAGE'], 'r', encoding='utf-8') as f:
-        msg = yaml.safe_load(f.read())
-        app.config.update(msg)
+    # 读取msg配置，建立响应消息表
+    messages.init_app(app)
+
+    # 注册命令行工具
+    register_commands(app)
 
     return app
 
@@ -94,6 +121,19 @@ def read_yaml(config_name, config_path):
         raise ValueError('请输入正确的配置名称或配置文件路径')
 
 
+def register_commands(app):
+    """
+    注册flask命令行工具
+    :param app:
+    :return:
+    """
+
+    @app.cli.command('search-index')
+    def search_index():
+        """创建用户搜索全文索引"""
+        user_search.create_index()
+
+
 def register_api(app, routers):
     for router_api in routers:
         if isinstance(router_api, Blueprint):
@@ -1,17 +1,38 @@
 from werkzeug.security import generate_password_hash, check_password_hash
 from app.utils.core import db
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload, aliased
 from datetime import datetime, timedelta
-from flask import current_app, url_for
+from flask import current_app, url_for, abort
 from hashlib import md5
 import jwt
 import json
+import base64
 
 class PaginatedAPIMixin(object):
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    # to_dict 需要用到的关联关系，分页查询时一次性加载，避免逐行懒加载
+    serialize_relations = ()
+    # 游标分页的排序列，组合起来必须唯一且有索引
+    cursor_columns = ('id',)
+
+    @classmethod
+    def eager_query(cls, query):
+        '''给查询加上序列化所需的关联加载选项'''
+        if cls.serialize_relations:
+            query = query.options(*[joinedload(name) for name in cls.serialize_relations])
+        return query
+
+    @classmethod
+    def prefetch(cls, items):
+        '''批量预取 to_dict 需要的聚合数据，由子类按需实现'''
+        pass
+
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, **kwargs):
         # 如果当前没有任何资源时，或者前端请求的 page 越界时，都会抛出 404 错误
         # 由 @bp.app_errorhandler(404) 自动处理，即响应 JSON 数据：{ error: "Not Found" }
-        resources = query.paginate(page, per_page)
+        resources = cls.eager_query(query).paginate(page, per_page)
+        cls.prefetch(resources.items)
         data = {
             'items': [item.to_dict() for item in resources.items],
             '_meta': {
@@ -31,6 +52,88 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    @classmethod
+    def encode_cursor(cls, item, backward=False):
+        '''将一行的排序列的值编码为不透明的游标'''
+        values = list()
+        for name in cls.cursor_columns:
+            value = getattr(item, name)
+            values.append(value.isoformat() if isinstance(value, datetime) else value)
+        raw = json.dumps([1 if backward else 0, values])
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8')
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        '''解析游标，返回 (排序列的值, 是否向前翻页)'''
+        try:
+            backward, values = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+            if len(values) != len(cls.cursor_columns):
+                raise ValueError(cursor)
+            for i, name in enumerate(cls.cursor_columns):
+                if values[i] is not None and isinstance(getattr(cls, name).type, db.DateTime):
+                    values[i] = datetime.fromisoformat(values[i])
+        except (ValueError, TypeError):
+            abort(400, '无效的分页游标')
+        return values, bool(backward)
+
+    @staticmethod
+    def keyset_filter(columns, values, reverse):
+        '''(a, b) > (x, y) 展开为 a > x OR (a = x AND b > y)，保证能走索引'''
+        conditions = list()
+        for i, column in enumerate(columns):
+            compare = column < values[i] if reverse else column > values[i]
+            conditions.append(and_(*[columns[j] == values[j] for j in range(i)], compare))
+        return or_(*conditions)
+
+    @classmethod
+    def to_cursor_dict(cls, query, cursor, per_page, endpoint, descending=False, with_total=False, **kwargs):
+        '''
+        游标分页，不使用 OFFSET，翻页开销与页码无关
+        :param query: 查询
+        :param cursor: 上一次返回的游标，第一页为空字符串
+        :param per_page: 每页数量
+        :param endpoint: 生成链接的端点
+        :param descending: 是否按排序列倒序
+        :param with_total: 是否返回总数，总数会被缓存
+        '''
+        columns = [getattr(cls, name) for name in cls.cursor_columns]
+        values, backward = cls.decode_cursor(cursor) if cursor else (None, False)
+        # 向前翻页时反向查询，取出后再反转回来
+        reverse = descending != backward
+        query = query.order_by(None)
+        total = None
+        if with_total:
+            # 写在函数内是为了防止循环导入
+            from app.utils.cache import cached_count
+            total = cached_count(query)
+        if values is not None:
+            query = query.filter(cls.keyset_filter(columns, values, reverse))
+        query = query.order_by(*[column.desc() if reverse else column.asc() for column in columns])
+        items = cls.eager_query(query).limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        if backward:
+            items.reverse()
+        cls.prefetch(items)
+
+        has_next = values is not None if backward else has_more
+        has_prev = has_more if backward else values is not None
+        data = {
+            'items': [item.to_dict() for item in items],
+            '_meta': {
+                'per_page': per_page,
+                'total_items': total
+            },
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page, **kwargs),
+                'next': url_for(endpoint, cursor=cls.encode_cursor(items[-1]), per_page=per_page,
+                                **kwargs) if items and has_next else None,
+                'prev': url_for(endpoint, cursor=cls.encode_cursor(items[0], backward=True), per_page=per_page,
+                                **kwargs) if items and has_prev else None
+            }
+        }
+        return data
+
 class User(PaginatedAPIMixin, db.Model):
     # 设置数据库表名，Post模型中的外键 user_id 会引用 users.id
     __tablename__ = 'users'
@@ -48,6 +151,7 @@ class User(PaginatedAPIMixin, db.Model):
     remark = db.Column(db.Text())
     operation = db.relationship('Operation', backref='operator', lazy='dynamic',
                             cascade='all, delete-orphan')
+    serialize_relations = ('department',)
 
     def __repr__(self):
         return '<User {}>'.format(self.username)
@@ -111,8 +215,8 @@ class User(PaginatedAPIMixin, db.Model):
             algorithm='HS256').decode('utf-8')
 
     @staticmethod
-    def verify_jwt(token):
-        '''验证 JWT 的有效性'''
+    def decode_jwt(token):
+        '''解析 JWT，无效时返回 None'''
         try:
             payload = jwt.decode(
                 token,
@@ -123,6 +227,14 @@ class User(PaginatedAPIMixin, db.Model):
                 jwt.exceptions.DecodeError) as e:
             # Token过期，或被人修改，那么签名验证也会失败
             return None
+        return payload
+
+    @staticmethod
+    def verify_jwt(token):
+        '''验证 JWT 的有效性'''
+        payload = User.decode_jwt(token)
+        if payload is None:
+            return None
         return User.query.get(payload.get('user_id'))
     
     # def get_permissions(self):
@@ -130,13 +242,10 @@ class User(PaginatedAPIMixin, db.Model):
 
     def can(self, operate_permission):
         #这个方法用来传入一个权限来核实用户是否有这个权限,返回bool值，检查permissions要求的权限角色是否允许
-        d = Department.query.get(self.department_id)
-        if not d.get("active"):
-            return False
-        self.permissions = d.get("permissions")
-        self.permissions = json.loads(self.permissions)
+        # 写在函数内是为了防止循环导入
+        from app.utils.cache import permission_cache
         (op_key, op_val), = operate_permission.items()
-        return op_val in self.permissions[op_key]
+        return (op_key, op_val) in permission_cache.get(self.department_id)
         
         
     # def is_administrator(self):
@@ -149,6 +258,7 @@ class Department(PaginatedAPIMixin, db.Model):
     name = db.Column(db.String(120), index=True, unique=True)
     describe = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.now)
+    cursor_columns = ('timestamp', 'id')
     members = db.relationship('User', backref='department', lazy='dynamic',
                                cascade='all, delete-orphan')
     active = db.Column(db.Boolean, default=True)
@@ -157,13 +267,26 @@ class Department(PaginatedAPIMixin, db.Model):
     def __repr__(self):
         return '<Department {}>'.format(self.id)
 
+    @classmethod
+    def prefetch(cls, items):
+        '''一条分组 COUNT 查询取出本页所有部门的成员数'''
+        ids = [item.id for item in items]
+        if not ids:
+            return
+        counts = dict(db.session.query(User.department_id, db.func.count(User.id))
+                      .filter(User.department_id.in_(ids))
+                      .group_by(User.department_id))
+        for item in items:
+            item._members_count = counts.get(item.id, 0)
+
     def to_dict(self):
+        members_count = getattr(self, '_members_count', None)
         data = {
             'id': self.id,
             'name': self.name,
             'timestamp': self.timestamp,
             'describe': self.describe,
-            'members_count': self.members.count(),
+            'members_count': self.members.count() if members_count is None else members_count,
             'active': self.active,
             'permissions': self.permissions
         }
@@ -177,13 +300,154 @@ class Department(PaginatedAPIMixin, db.Model):
             if field in data:
                 setattr(self, field, data[field])
 
+class CategoryClosure(db.Model):
+    '''分类的闭包表，保存每个分类与其所有祖先(包括自身)的关系'''
+    __tablename__ = 'category_closure'
+    __table_args__ = (
+        # 按祖先查子树，可限制层数
+        db.Index('ix_category_closure_ancestor_depth', 'ancestor_id', 'depth'),
+        # 按子孙查祖先
+        db.Index('ix_category_closure_descendant_depth', 'descendant_id', 'depth'),
+    )
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('categories.id', ondelete='CASCADE'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('categories.id', ondelete='CASCADE'), primary_key=True)
+    # 祖先到子孙的层数，自身为0
+    depth = db.Column(db.Integer, nullable=False)
+
+
+class Category(PaginatedAPIMixin, db.Model):
+    '''
+    无限层级分类
+    层级关系同时保存在 father_id 和闭包表 category_closure 中，
+    子树、祖先、限定层数的查询都只需要一条SQL。
+    '''
+    __tablename__ = 'categories'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), index=True)
+    father_id = db.Column(db.Integer, db.ForeignKey('categories.id', ondelete='CASCADE'), index=True)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.now)
+
+    def __repr__(self):
+        return '<Category {}>'.format(self.id)
+
+    def to_dict(self):
+        data = {
+            'id': self.id,
+            'name': self.name,
+            'father_id': self.father_id,
+            'timestamp': self.timestamp
+        }
+        return data
+
+    def from_dict(self, data):
+        for field in ['name']:
+            if field in data:
+                setattr(self, field, data[field])
+
+    def to_node(self):
+        '''Tree 需要的节点格式'''
+        return {'id': self.id, 'father_id': self.father_id, 'name': self.name}
+
+    @classmethod
+    def create(cls, data):
+        '''新建分类并写入闭包表，由调用方提交事务'''
+        category = cls()
+        category.from_dict(data)
+        category.father_id = data.get('father_id')
+        db.session.add(category)
+        db.session.flush()
+        rows = [{'ancestor_id': category.id, 'descendant_id': category.id, 'depth': 0}]
+        if category.father_id is not None:
+            rows.extend({'ancestor_id': ancestor_id, 'descendant_id': category.id, 'depth': depth + 1}
+                        for ancestor_id, depth in db.session.query(CategoryClosure.ancestor_id, CategoryClosure.depth)
+                        .filter(CategoryClosure.descendant_id == category.father_id))
+        db.session.execute(CategoryClosure.__table__.insert(), rows)
+        return category
+
+    def move(self, father_id):
+        '''
+        把分类(连同子树)移动到新的父分类下，由调用方提交事务
+        :param father_id: 新的父分类ID，None表示移动为根分类
+        '''
+        closure = CategoryClosure
+        subtree = db.session.query(closure.descendant_id, closure.depth) \
+            .filter(closure.ancestor_id == self.id).all()
+        subtree_ids = [descendant_id for descendant_id, _ in subtree]
+        if father_id in subtree_ids:
+            raise ValueError('不能移动到自身或子分类下')
+        # 删除旧祖先与子树之间的关系，子树内部的关系不变
+        old_ancestors = db.session.query(closure.ancestor_id) \
+            .filter(closure.descendant_id == self.id, closure.depth > 0)
+        db.session.query(closure) \
+            .filter(closure.descendant_id.in_(subtree_ids),
+                    closure.ancestor_id.in_([ancestor_id for ancestor_id, in old_ancestors])) \
+            .delete(synchronize_session=False)
+        if father_id is not None:
+            new_ancestors = db.session.query(closure.ancestor_id, closure.depth) \
+                .filter(closure.descendant_id == father_id).all()
+            rows = [{'ancestor_id': ancestor_id, 'descendant_id': descendant_id, 'depth': up + down + 1}
+                    for ancestor_id, up in new_ancestors for descendant_id, down in subtree]
+            if rows:
+                db.session.execute(closure.__table__.insert(), rows)
+        self.father_id = father_id
+
+    def delete_subtree(self):
+        '''删除分类及其所有子分类，由调用方提交事务'''
+        subtree_ids = [descendant_id for descendant_id, in db.session.query(CategoryClosure.descendant_id)
+                       .filter(CategoryClosure.ancestor_id == self.id)]
+        CategoryClosure.query.filter(CategoryClosure.descendant_id.in_(subtree_ids)) \
+            .delete(synchronize_session=False)
+        Category.query.filter(Category.id.in_(subtree_ids)).delete(synchronize_session=False)
+        return subtree_ids
+
+    @classmethod
+    def subtree(cls, category_id, max_depth=None):
+        '''
+        分类及其子孙分类，一条查询
+        :param category_id: 分类ID
+        :param max_depth: 最多向下查询的层数，None不限制
+        :return: [Category, ...]
+        '''
+        query = cls.query.join(CategoryClosure, CategoryClosure.descendant_id == cls.id) \
+            .filter(CategoryClosure.ancestor_id == category_id)
+        if max_depth is not None:
+            query = query.filter(CategoryClosure.depth <= max_depth)
+        return query.order_by(cls.id).all()
+
+    @classmethod
+    def ancestors(cls, category_id):
+        '''
+        分类的所有祖先，从根分类开始，一条查询
+        '''
+        return cls.query.join(CategoryClosure, CategoryClosure.ancestor_id == cls.id) \
+            .filter(CategoryClosure.descendant_id == category_id, CategoryClosure.depth > 0) \
+            .order_by(CategoryClosure.depth.desc()).all()
+
+    @classmethod
+    def levels(cls, max_depth):
+        '''
+        从根分类开始向下 max_depth 层的所有分类，一条查询
+        '''
+        root = aliased(cls)
+        return cls.query.join(CategoryClosure, CategoryClosure.descendant_id == cls.id) \
+            .join(root, root.id == CategoryClosure.ancestor_id) \
+            .filter(root.father_id.is_(None), CategoryClosure.depth <= max_depth) \
+            .order_by(cls.id).all()
+
+
 class Operation(PaginatedAPIMixin, db.Model):
     __tablename__ = 'operations'
+    __table_args__ = (
+        # 按操作人筛选日期区间
+        db.Index('ix_operations_operator_id_timestamp', 'operator_id', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     operator_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     describe = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.now)
     ip = db.Column(db.Text)
+    serialize_relations = ('operator',)
+    cursor_columns = ('timestamp', 'id')
 
     def from_dict(self, data):
         for field in ['operator_id', 'describe', 'ip']:
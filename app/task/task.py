@@ -1,6 +1,9 @@
 from datetime import datetime
 from app.models.model import User
+from flask import current_app
 from app.utils.core import db
+from app.utils.jobs import evict_reports
+from app.utils.last_seen import last_seen_tracker
 
 
 def my_job():
@@ -11,3 +14,22 @@ def db_query():
     with db.app.app_context():
         data = db.session.query(User).first()
         print(data)
+
+
+def flush_last_seen():
+    """
+    批量写入用户最后访问时间
+    """
+    with db.app.app_context():
+        last_seen_tracker.flush()
+
+
+def evict_report_files():
+    """
+    清理报表目录
+    """
+    with db.app.app_context():
+        config = current_app.config
+        evict_reports(config.get("REPORT_PATH", "./report"),
+                      config.get("REPORT_CACHE_MAX_BYTES", 1024 * 1024 * 1024),
+                      config.get("REPORT_CACHE_MAX_AGE", 7 * 24 * 3600))
@@ -0,0 +1,82 @@
+import io
+import os
+import threading
+
+from docxtpl import DocxTemplate
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+
+
+class ReportAssets(object):
+    """
+    报表资源缓存
+    word模板文件只读取一次，每次渲染用缓存的内容新建模板(DocxTemplate 不能深拷贝)；
+    字体每个进程只注册一次；图片只读取一次。文件修改时间变化后自动重新加载。
+    """
+
+    def __init__(self):
+        # path: (mtime, bytes)
+        self._templates = dict()
+        # name: (path, mtime)
+        self._fonts = dict()
+        # path: (mtime, bytes)
+        self._images = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def mtime(path):
+        return os.stat(path).st_mtime
+
+    def version(self, *paths):
+        """
+        资源版本，用于判断报表是否需要重新生成
+        :param paths: 报表用到的资源路径
+        :return: 各资源修改时间组成的元组
+        """
+        return tuple(self.mtime(path) for path in paths)
+
+    def template(self, path):
+        """
+        获取word模板
+        :param path: 模板路径
+        :return: 新建的模板，可直接渲染
+        """
+        mtime = self.mtime(path)
+        item = self._templates.get(path)
+        if item is None or item[0] != mtime:
+            with open(path, 'rb') as f:
+                item = (mtime, f.read())
+            self._templates[path] = item
+        return DocxTemplate(io.BytesIO(item[1]))
+
+    def font(self, name, path):
+        """
+        注册字体
+        :param name: 字体名称
+        :param path: 字体文件路径
+        :return:
+        """
+        key = (path, self.mtime(path))
+        if self._fonts.get(name) == key:
+            return
+        with self._lock:
+            if self._fonts.get(name) != key:
+                pdfmetrics.registerFont(TTFont(name, path))
+                self._fonts[name] = key
+
+    def image(self, path):
+        """
+        获取图片
+        :param path: 图片路径
+        :return: 图片内容的文件对象，每次调用返回新的对象
+        """
+        mtime = self.mtime(path)
+        item = self._images.get(path)
+        if item is None or item[0] != mtime:
+            with open(path, 'rb') as f:
+                item = (mtime, f.read())
+            self._images[path] = item
+        return io.BytesIO(item[1])
+
+
+report_assets = ReportAssets()
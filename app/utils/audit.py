@@ -0,0 +1,162 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from app.models.model import Operation
+from app.utils.core import db
+
+logger = logging.getLogger(__name__)
+
+
+class AuditLog(object):
+    """
+    操作日志异步批量写入
+    请求线程只把日志放入有界队列，后台线程攒够 AUDIT_BATCH_SIZE 条或每隔
+    AUDIT_FLUSH_INTERVAL 秒用一条多行INSERT写入数据库。
+    队列已满时等待 AUDIT_PUT_TIMEOUT 秒，仍然写不进去则由请求线程同步写入，写入失败时请求失败；
+    后台写入失败时按 AUDIT_RETRY_BACKOFF * 2^n 秒退避重试，最多 AUDIT_MAX_RETRIES 次，
+    仍然失败则把日志内容写入应用日志，不会静默丢弃。进程退出时写完队列中剩余的日志。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = True
+        self.batch_size = 200
+        self.flush_interval = 1
+        self.put_timeout = 0.05
+        self.max_retries = 3
+        self.retry_backoff = 0.5
+        self.queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('AUDIT_ASYNC', True)
+        self.batch_size = app.config.get('AUDIT_BATCH_SIZE', 200)
+        self.flush_interval = app.config.get('AUDIT_FLUSH_INTERVAL', 1)
+        self.put_timeout = app.config.get('AUDIT_PUT_TIMEOUT', 0.05)
+        self.max_retries = app.config.get('AUDIT_MAX_RETRIES', 3)
+        self.retry_backoff = app.config.get('AUDIT_RETRY_BACKOFF', 0.5)
+        self.queue = queue.Queue(maxsize=app.config.get('AUDIT_QUEUE_SIZE', 10000))
+        atexit.register(self.shutdown)
+
+    def _ensure_started(self):
+        """
+        启动后台写入线程，gunicorn等fork之后的子进程需要重新启动
+        """
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='audit-log', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def record(self, operator_id, describe, ip):
+        """
+        记录一条操作日志
+        :param operator_id: 操作人ID
+        :param describe: 操作描述
+        :param ip: 请求IP
+        :return:
+        """
+        row = {"operator_id": operator_id, "describe": describe, "ip": ip, "timestamp": datetime.now()}
+        if not self.enabled:
+            self._insert([row])
+            return
+        self._ensure_started()
+        try:
+            self.queue.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            logger.warning("操作日志队列已满，改为同步写入")
+            self._insert([row])
+
+    def _take(self):
+        """
+        从队列中取出一批日志，数量达到 batch_size 或等待超过 flush_interval 即返回
+        """
+        rows = list()
+        try:
+            rows.append(self.queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return rows
+        deadline = time.monotonic() + self.flush_interval
+        while len(rows) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return rows
+
+    def _insert(self, rows):
+        """
+        多行INSERT写入，使用独立连接，不影响请求中的session，失败时抛出异常
+        """
+        with self.app.app_context():
+            db.engine.execute(Operation.__table__.insert(), rows)
+
+    def _write(self, rows):
+        """
+        后台写入一批日志，失败时退避重试，重试次数用完后把日志内容写入应用日志
+        """
+        if not rows:
+            return
+        attempt = 0
+        while True:
+            try:
+                self._insert(rows)
+                return
+            except Exception as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.exception("写入操作日志失败，已重试%s次: %s", self.max_retries, e)
+                    for row in rows:
+                        logger.error("未写入的操作日志: %s", row)
+                    return
+                logger.warning("写入操作日志失败，第%s次重试: %s", attempt, e)
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._write(self._take())
+
+    def flush(self):
+        """
+        立即写入队列中的所有日志
+        """
+        rows = list()
+        while True:
+            try:
+                rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(rows) >= self.batch_size:
+                self._write(rows)
+                rows = list()
+        self._write(rows)
+
+    def shutdown(self, timeout=5):
+        """
+        停止后台线程并写完剩余日志
+        """
+        self._stop.set()
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._thread.join(timeout)
+        self.flush()
+
+
+audit_log = AuditLog()
@@ -6,8 +6,10 @@ from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from functools import wraps
 from app.utils.code import ResponseCode
 from app.utils.util import ResMsg
-from app.models.model import User, Department, Operation
-from app.utils.core import db
+from app.models.model import User, Department
+from app.utils.cache import user_cache
+from app.utils.last_seen import last_seen_tracker
+from app.utils.audit import audit_log
 
 token_auth = HTTPTokenAuth()
 
@@ -184,11 +186,12 @@ def verify_jwt_token(f):
 @token_auth.verify_token
 def verify_token(token):
     '''用于检查用户请求是否有token，并且token真实存在，还在有效期内'''
-    g.current_user = User.verify_jwt(token) if token else None
+    payload = User.decode_jwt(token) if token else None
+    # 优先从缓存中获取用户，避免每次认证都查询数据库
+    g.current_user = user_cache.get(payload.get('user_id'), payload.get('iat')) if payload else None
     if g.current_user:
-        # 每次认证通过后（即将访问资源API），更新 last_seen 时间
-        g.current_user.ping()
-        db.session.commit()
+        # 每次认证通过后（即将访问资源API），记录 last_seen 时间，按配置的粒度延迟写入
+        last_seen_tracker.touch(g.current_user)
         # department_id = g.current_user.get('department_id')
         # g.current_auth = Department.query.get(department_id).get('auth')
     return g.current_user is not None
@@ -217,11 +220,8 @@ def record_operation(describe):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args,**kwargs):
-            operation = Operation()
-            operation.from_dict({"operator_id":g.current_user.get("id"),\
-                                "describe":describe, "ip":request.remote_addr})
-            db.session.add(operation)
-            db.session.commit()
+            # 日志放入队列后由后台线程批量写入
+            audit_log.record(g.current_user.get("id"), describe, request.remote_addr)
             return f(*args,**kwargs)
         return decorated_function
     return decorator
\ No newline at end of file
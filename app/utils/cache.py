@@ -0,0 +1,277 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import redis
+from flask import current_app
+from sqlalchemy.orm import make_transient_to_detached
+
+from app.models.model import User, Department
+from app.utils.core import db
+from app.utils.util import Redis
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """
+    进程内带过期时间的LRU缓存，线程安全
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        读取缓存，过期或不存在时返回默认值
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expire_at = item
+            if expire_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        写入缓存，超出容量时淘汰最久未使用的键
+        """
+        expire_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """
+        删除指定键
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        """
+        删除所有满足条件的键
+        """
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class UserCache(object):
+    """
+    认证用户两级缓存
+    第一级为进程内LRU，以 (user_id, iat) 为键，过期时间很短，用来吸收同一token的高频请求；
+    第二级为Redis，以 user_id 为键，多个worker共享。
+    用户或所属部门被修改时需调用 invalidate 使缓存失效。
+    密码哈希等凭据不写入缓存，由缓存还原的用户访问这些字段时会从数据库读取。
+    """
+    # 不缓存的列
+    exclude = ('password_hash',)
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.local = LRUCache()
+        self.redis_ttl = 300
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('AUTH_CACHE_OPEN', True)
+        self.local = LRUCache(app.config.get('AUTH_CACHE_LOCAL_SIZE', 1024),
+                              app.config.get('AUTH_CACHE_LOCAL_TTL', 5))
+        self.redis_ttl = app.config.get('AUTH_CACHE_REDIS_TTL', 300)
+
+    @staticmethod
+    def _key(user_id):
+        return 'auth_user:{}'.format(user_id)
+
+    @classmethod
+    def _dump(cls, user):
+        """
+        将用户的列数据转换为可缓存的字典，不包括密码哈希
+        """
+        return {column.name: getattr(user, column.name) for column in User.__table__.columns
+                if column.name not in cls.exclude}
+
+    @staticmethod
+    def _load(data):
+        """
+        由缓存数据还原用户对象，并以持久化状态挂到当前session，不产生查询
+        """
+        user = User(**data)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @staticmethod
+    def _encode(data):
+        return json.dumps({key: value.isoformat() if isinstance(value, datetime) else value
+                           for key, value in data.items()})
+
+    @staticmethod
+    def _decode(raw):
+        data = json.loads(raw)
+        for column in User.__table__.columns:
+            value = data.get(column.name)
+            if value is not None and isinstance(column.type, db.DateTime):
+                data[column.name] = datetime.fromisoformat(value)
+        return data
+
+    def _redis_get(self, user_id):
+        try:
+            raw = Redis.read(self._key(user_id))
+        except redis.RedisError as e:
+            logger.warning("读取用户缓存失败: %s", e)
+            return None
+        return self._decode(raw) if raw else None
+
+    def _redis_set(self, user_id, data):
+        try:
+            Redis.write(self._key(user_id), self._encode(data), self.redis_ttl)
+        except redis.RedisError as e:
+            logger.warning("写入用户缓存失败: %s", e)
+
+    def get(self, user_id, iat=None):
+        """
+        获取认证用户，依次查找进程内缓存、Redis、数据库
+        :param user_id: 用户ID
+        :param iat: token签发时间
+        :return: User 或 None
+        """
+        if user_id is None:
+            return None
+        if not self.enabled:
+            return User.query.get(user_id)
+
+        data = self.local.get((user_id, iat))
+        if data is None:
+            data = self._redis_get(user_id)
+            if data is None:
+                user = User.query.get(user_id)
+                if user is None:
+                    return None
+                data = self._dump(user)
+                self._redis_set(user_id, data)
+                self.local.set((user_id, iat), data)
+                return user
+            self.local.set((user_id, iat), data)
+        return self._load(data)
+
+    def invalidate(self, *user_ids):
+        """
+        使指定用户的缓存失效
+        其他worker的进程内缓存会在 AUTH_CACHE_LOCAL_TTL 秒内自然过期
+        """
+        if not user_ids:
+            return
+        ids = set(user_ids)
+        self.local.delete_where(lambda key: key[0] in ids)
+        try:
+            Redis.delete(*[self._key(user_id) for user_id in ids])
+        except redis.RedisError as e:
+            logger.warning("删除用户缓存失败: %s", e)
+
+
+class PermissionCache(object):
+    """
+    部门权限缓存
+    部门的权限json编译为 (key, value) 组成的 frozenset，按部门缓存在进程内。
+    部门创建或修改后调用 invalidate 递增Redis中的版本号，各worker每隔
+    PERMISSION_CACHE_CHECK_INTERVAL 秒比对一次版本号，不一致时清空本地缓存。
+    """
+    version_key = 'permissions:version'
+
+    def __init__(self, app=None):
+        self.check_interval = 1
+        self._permissions = dict()
+        self._version = None
+        self._checked_at = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.check_interval = app.config.get('PERMISSION_CACHE_CHECK_INTERVAL', 1)
+
+    @staticmethod
+    def compile(department):
+        """
+        编译部门权限
+        :param department: 部门
+        :return: frozenset((key, value), ...)，部门不存在或未启用时为空集合
+        """
+        if department is None or not department.get("active"):
+            return frozenset()
+        permissions = json.loads(department.get("permissions") or "{}")
+        return frozenset((key, value) for key, values in permissions.items() for value in values)
+
+    def _sync_version(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            version = Redis.read(self.version_key)
+        except redis.RedisError as e:
+            logger.warning("读取权限版本号失败: %s", e)
+            return
+        if version != self._version:
+            self._permissions = dict()
+            self._version = version
+
+    def get(self, department_id):
+        """
+        获取部门编译后的权限集合
+        """
+        self._sync_version()
+        permissions = self._permissions.get(department_id)
+        if permissions is None:
+            permissions = self.compile(Department.query.get(department_id))
+            self._permissions[department_id] = permissions
+        return permissions
+
+    def invalidate(self):
+        """
+        使所有worker的权限缓存失效
+        """
+        self._permissions = dict()
+        try:
+            self._version = str(Redis.incr(self.version_key))
+        except redis.RedisError as e:
+            logger.warning("更新权限版本号失败: %s", e)
+
+
+count_cache = LRUCache(maxsize=256)
+
+
+def cached_count(query):
+    """
+    带缓存的查询总数，缓存 PAGINATION_COUNT_TTL 秒
+    :param query: 查询
+    :return: 总数
+    """
+    compiled = query.statement.compile()
+    key = (str(compiled), repr(sorted(compiled.params.items())))
+    total = count_cache.get(key)
+    if total is None:
+        total = query.count()
+        count_cache.set(key, total, current_app.config.get('PAGINATION_COUNT_TTL', 60))
+    return total
+
+
+user_cache = UserCache()
+permission_cache = PermissionCache()
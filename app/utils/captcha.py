@@ -0,0 +1,145 @@
+import hashlib
+import hmac
+import json
+import logging
+import time
+import uuid
+
+import redis
+
+from app.utils.util import Redis, CaptchaTool
+
+logger = logging.getLogger(__name__)
+
+
+class CaptchaPool(object):
+    """
+    图形验证码池
+    预先生成的验证码存放在Redis中: 有序集合 captcha:pool 按过期时间保存验证码ID，
+    captcha:item:<id> 保存图片和答案哈希，并设置 CAPTCHA_TTL 过期。
+    取验证码时一个lua脚本原子地弹出一张并返回剩余数量，低于 CAPTCHA_POOL_LOW_WATER 时
+    抢到补充锁的请求触发celery任务 refill_captcha_pool 补满到 CAPTCHA_POOL_SIZE。
+    验证码池为空时才在web进程中直接生成。
+    """
+    pool_key = 'captcha:pool'
+    item_prefix = 'captcha:item:'
+    lock_key = 'captcha:refill_lock'
+
+    # KEYS: 验证码池, 补充锁
+    # ARGV: 当前毫秒时间戳, 验证码键前缀, 补充水位, 补充锁过期时间(秒)
+    pop_script = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, ARGV[1])
+    local value = false
+    while not value do
+        local ids = redis.call('ZRANGE', KEYS[1], 0, 0)
+        if #ids == 0 then
+            break
+        end
+        redis.call('ZREM', KEYS[1], ids[1])
+        local key = ARGV[2] .. ids[1]
+        value = redis.call('GET', key)
+        redis.call('DEL', key)
+    end
+    local refill = 0
+    if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) and
+            redis.call('SET', KEYS[2], 1, 'NX', 'EX', ARGV[4]) then
+        refill = 1
+    end
+    return {value, refill}
+    """
+
+    def __init__(self, app=None):
+        self.secret = b''
+        self.size = 500
+        self.low_water = 100
+        self.ttl = 600
+        self.lock_ttl = 60
+        self.batch_size = 100
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.secret = str(config['SECRET_KEY']).encode('utf-8')
+        self.size = config.get('CAPTCHA_POOL_SIZE', 500)
+        self.low_water = config.get('CAPTCHA_POOL_LOW_WATER', 100)
+        self.ttl = config.get('CAPTCHA_TTL', 600)
+        self.lock_ttl = config.get('CAPTCHA_REFILL_LOCK_TTL', 60)
+        self.batch_size = config.get('CAPTCHA_REFILL_BATCH', 100)
+
+    def hash(self, answer):
+        """
+        答案哈希，不区分大小写，JSON中的数字按字符串处理
+        """
+        return hmac.new(self.secret, str(answer).strip().lower().encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def verify(self, answer, answer_hash):
+        return hmac.compare_digest(self.hash(answer), answer_hash)
+
+    @staticmethod
+    def render(count=1):
+        """
+        生成验证码
+        :return: [(图片, 答案), ...]
+        """
+        return [(img.decode('utf-8'), code) for img, code in CaptchaTool.render_batch(count)]
+
+    def get(self):
+        """
+        获取一张验证码
+        :return: (图片, 答案哈希)
+        """
+        try:
+            value, refill = Redis.eval_script(self.pop_script, [self.pool_key, self.lock_key],
+                                              [int(time.time() * 1000), self.item_prefix, self.low_water,
+                                               self.lock_ttl])
+        except redis.RedisError as e:
+            logger.warning("读取验证码池失败: %s", e)
+            value, refill = None, 0
+        if refill:
+            self.trigger_refill()
+        if value:
+            data = json.loads(value)
+            return data['img'], data['hash']
+        img, code = self.render()[0]
+        return img, self.hash(code)
+
+    def trigger_refill(self):
+        # 写在函数内是为了防止循环导入
+        from app.celery import refill_captcha_pool
+        try:
+            refill_captcha_pool.delay()
+        except Exception as e:
+            logger.warning("提交验证码补充任务失败: %s", e)
+            Redis.delete(self.lock_key)
+
+    def refill(self):
+        """
+        补满验证码池，由celery任务执行
+        :return: 新增数量
+        """
+        try:
+            with Redis.pipeline() as pipe:
+                pipe.zremrangebyscore(self.pool_key, 0, int(time.time() * 1000))
+                pipe.zcard(self.pool_key)
+                count = self.size - pipe.execute()[1]
+            added = 0
+            while added < count:
+                batch = min(self.batch_size, count - added)
+                expire_at = int((time.time() + self.ttl) * 1000)
+                with Redis.pipeline(transaction=False) as pipe:
+                    members = dict()
+                    for img, code in self.render(batch):
+                        captcha_id = uuid.uuid4().hex
+                        pipe.set(self.item_prefix + captcha_id, json.dumps({'img': img, 'hash': self.hash(code)}),
+                                 ex=self.ttl)
+                        members[captcha_id] = expire_at
+                    pipe.zadd(self.pool_key, members)
+                    pipe.execute()
+                added += batch
+            return max(count, 0)
+        finally:
+            Redis.delete(self.lock_key)
+
+
+captcha_pool = CaptchaPool()
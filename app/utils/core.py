@@ -1,7 +1,9 @@
 import datetime
 import decimal
+import json
 import uuid
 
+from flask import current_app
 from flask.json import JSONEncoder as BaseJSONEncoder
 from flask_sqlalchemy import SQLAlchemy
 from flask_apscheduler import APScheduler
@@ -35,3 +37,48 @@ class JSONEncoder(BaseJSONEncoder):
             # 格式化字节数据
             return o.decode("utf-8")
         return super(JSONEncoder, self).default(o)
+
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# 时间交给 _default 处理，保持与 JSONEncoder 相同的格式
+ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+
+def _default(o):
+    """
+    orjson 不能直接序列化的类型，格式与 JSONEncoder 相同
+    uuid 由 orjson 原生处理
+    """
+    if isinstance(o, datetime.datetime):
+        return o.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(o, datetime.date):
+        return o.strftime('%Y-%m-%d')
+    if isinstance(o, decimal.Decimal):
+        return str(o)
+    if isinstance(o, bytes):
+        return o.decode("utf-8")
+    raise TypeError
+
+
+def dumps(obj):
+    """
+    序列化为json字节串，安装了orjson时使用orjson，
+    orjson不支持的数据(如超过64位的整数、自定义对象)回退到 JSONEncoder
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=_default, option=ORJSON_OPTIONS)
+        except TypeError:
+            pass
+    return json.dumps(obj, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def json_response(obj, status=None):
+    """
+    返回json响应，代替 jsonify
+    """
+    return current_app.response_class(dumps(obj), status=status, mimetype='application/json')
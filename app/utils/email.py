@@ -1,24 +1,304 @@
-from threading import Thread
-from flask import current_app
-from flask_mail import Message
-from flask_mail import Mail
-import os
-mail = Mail()
-
-def send_async_email(app, subject, sender, recipients, html_body, attachments):
-    with app.app_context():
-        msg = Message(subject, sender=sender, recipients=recipients)
-        msg.html = html_body
-        if attachments:
-            for attachment in attachments:
-                # msg.attach(*attachment)
-                file_name = os.path.basename(attachment)
-                with current_app.open_resource(attachment) as fp:
-                    msg.attach(file_name, 'application/x-gzip', fp.read())
-        mail.send(msg)
-
-
-def send_email(subject, sender, recipients, html_body,
-               attachments=None):
-        Thread(target=send_async_email, args=(current_app._get_current_object(), \
-            subject, sender, recipients, html_body, attachments)).start()
+import atexit
+import collections
+import gzip
+import logging
+import mimetypes
+import os
+import queue
+import smtplib
+import threading
+import time
+from flask import current_app
+from flask_mail import Message
+from flask_mail import Mail
+
+logger = logging.getLogger(__name__)
+
+mail = Mail()
+
+
+class AttachmentStore(object):
+    """
+    邮件附件缓存
+    附件按 (路径, 修改时间) 缓存在进程内，同一个文件发给多个收件人时只读取一次，
+    所有邮件共用同一份内容。总大小超过 MAIL_ATTACHMENT_CACHE_BYTES 时淘汰最久未使用的附件，
+    单个文件超过该大小时不缓存。MIME类型按文件名判断；开启 MAIL_ATTACHMENT_GZIP 时
+    未压缩的附件只压缩一次，文件名加上 .gz。
+    """
+    # 已压缩的格式，不再gzip
+    compressed_types = ('image/', 'audio/', 'video/', 'application/zip', 'application/gzip',
+                        'application/x-bzip2', 'application/x-xz', 'application/x-7z-compressed',
+                        'application/x-rar-compressed', 'application/pdf')
+    # zip(包括xlsx、docx)和gzip的文件头
+    compressed_magic = (b'PK\x03\x04', b'\x1f\x8b')
+    # mimetypes 返回的压缩编码对应的类型
+    encodings = {'gzip': 'application/gzip', 'bzip2': 'application/x-bzip2', 'xz': 'application/x-xz'}
+
+    def __init__(self, app=None):
+        self.max_bytes = 64 * 1024 * 1024
+        self.gzip = False
+        self.gzip_min_size = 1024
+        # (路径, 修改时间): (文件名, 类型, 内容)
+        self._items = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_bytes = app.config.get('MAIL_ATTACHMENT_CACHE_BYTES', 64 * 1024 * 1024)
+        self.gzip = app.config.get('MAIL_ATTACHMENT_GZIP', False)
+        self.gzip_min_size = app.config.get('MAIL_ATTACHMENT_GZIP_MIN_SIZE', 1024)
+
+    def content_type(self, file_name):
+        content_type, encoding = mimetypes.guess_type(file_name)
+        if encoding:
+            return self.encodings.get(encoding, 'application/octet-stream')
+        return content_type or 'application/octet-stream'
+
+    def _load(self, path):
+        file_name = os.path.basename(path)
+        content_type = self.content_type(file_name)
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        if self.gzip and len(data) >= self.gzip_min_size \
+                and not content_type.startswith(self.compressed_types) \
+                and not data.startswith(self.compressed_magic):
+            data = gzip.compress(data)
+            file_name, content_type = file_name + '.gz', 'application/gzip'
+        return file_name, content_type, data
+
+    def get(self, path):
+        """
+        获取附件
+        :param path: 附件路径，相对路径以应用目录为准，与 open_resource 相同
+        :return: (文件名, 类型, 内容)
+        """
+        path = os.path.join(current_app.root_path, path)
+        key = (path, os.stat(path).st_mtime)
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                return item
+        item = self._load(path)
+        size = len(item[2])
+        if size > self.max_bytes:
+            return item
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = item
+                self._size += size
+            while self._size > self.max_bytes:
+                _, (_, _, data) = self._items.popitem(last=False)
+                self._size -= len(data)
+        return item
+
+
+attachment_store = AttachmentStore()
+
+
+class MailDispatcher(object):
+    """
+    邮件发送队列
+    send_email 只把邮件放入有界队列，MAIL_WORKERS 个后台线程取出一批邮件后通过 mail.connect()
+    打开一个SMTP连接依次发送，队列空闲 MAIL_IDLE_TIMEOUT 秒后才关闭连接，突发的大量邮件
+    只需要少量的TCP/TLS握手(每个连接最多发送 MAIL_MAX_EMAILS 封后由 flask_mail 自动重连)。
+    连接失败或断开时按 MAIL_RETRY_BACKOFF * 2^n 秒退避重试未发送的邮件，最多 MAIL_MAX_RETRIES 次；
+    收件人被拒绝等永久错误只丢弃该邮件。附件在后台线程发送时才读取，见 AttachmentStore。
+    本地测试可以用 aiosmtpd 代替SMTP服务器:
+        python -m aiosmtpd -n -l localhost:8025
+    并配置 MAIL_SERVER: localhost, MAIL_PORT: 8025。
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = True
+        self.workers = 2
+        self.batch_size = 50
+        self.idle_timeout = 5
+        self.max_retries = 3
+        self.retry_backoff = 1
+        self.put_timeout = 0.5
+        self.queue = queue.Queue(maxsize=1000)
+        self._threads = list()
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('MAIL_ASYNC', True)
+        self.workers = app.config.get('MAIL_WORKERS', 2)
+        self.batch_size = app.config.get('MAIL_BATCH_SIZE', 50)
+        self.idle_timeout = app.config.get('MAIL_IDLE_TIMEOUT', 5)
+        self.max_retries = app.config.get('MAIL_MAX_RETRIES', 3)
+        self.retry_backoff = app.config.get('MAIL_RETRY_BACKOFF', 1)
+        self.put_timeout = app.config.get('MAIL_PUT_TIMEOUT', 0.5)
+        self.queue = queue.Queue(maxsize=app.config.get('MAIL_QUEUE_SIZE', 1000))
+        atexit.register(self.shutdown)
+
+    def _alive(self):
+        return self._pid == os.getpid() and all(thread.is_alive() for thread in self._threads)
+
+    def _ensure_started(self):
+        """
+        启动后台发送线程，gunicorn等fork之后的子进程需要重新启动
+        """
+        if self._alive():
+            return
+        with self._lock:
+            if self._alive():
+                return
+            self._stop.clear()
+            self._threads = [thread for thread in self._threads
+                             if self._pid == os.getpid() and thread.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._run, name='mail-{}'.format(i), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def submit(self, subject, sender, recipients, html_body, attachments=None):
+        """
+        提交一封邮件
+        :param subject: 主题
+        :param sender: 发件人
+        :param recipients: 收件人列表
+        :param html_body: html正文
+        :param attachments: 附件路径列表
+        :return:
+        """
+        job = dict(subject=subject, sender=sender, recipients=recipients,
+                   html_body=html_body, attachments=attachments or [])
+        if not self.enabled:
+            self._deliver([job])
+            return
+        self._ensure_started()
+        try:
+            self.queue.put(job, timeout=self.put_timeout)
+        except queue.Full:
+            logger.warning("邮件队列已满，改为同步发送")
+            # 只发送本封邮件，不在请求线程中继续处理队列
+            self._deliver([job], drain=False)
+
+    def _take(self, timeout):
+        """
+        取出一批邮件，等待 timeout 秒仍没有邮件时返回空列表
+        """
+        try:
+            jobs = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return list()
+        while len(jobs) < self.batch_size:
+            try:
+                jobs.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    @staticmethod
+    def message(job, attachments=None):
+        """
+        生成邮件
+        :param job: 邮件内容
+        :param attachments: 本批邮件共用的附件 {路径: (文件名, 类型, 内容)}，不在缓存中的大文件也只读取一次
+        :return:
+        """
+        if attachments is None:
+            attachments = dict()
+        msg = Message(job['subject'], sender=job['sender'], recipients=job['recipients'])
+        msg.html = job['html_body']
+        for path in job['attachments']:
+            if path not in attachments:
+                attachments[path] = attachment_store.get(path)
+            msg.attach(*attachments[path])
+        return msg
+
+    def _send(self, connection, job, attachments=None):
+        """
+        发送一封邮件，永久错误时记录日志并丢弃，连接错误向上抛出由调用方重试
+        """
+        try:
+            msg = self.message(job, attachments)
+        except OSError as e:
+            # 附件不存在等本地错误不影响同一连接中的其他邮件
+            logger.exception("邮件生成失败: %s %s", job['subject'], e)
+            return
+        try:
+            connection.send(msg)
+        except smtplib.SMTPRecipientsRefused as e:
+            logger.error("邮件收件人被拒绝: %s %s", job['subject'], e.recipients)
+        except smtplib.SMTPResponseException as e:
+            if not 500 <= e.smtp_code < 600:
+                raise
+            logger.error("邮件被拒绝: %s %s %s", job['subject'], e.smtp_code, e.smtp_error)
+
+    def _deliver(self, jobs, drain=True):
+        """
+        通过一个连接发送一批邮件
+        :param jobs: 邮件列表
+        :param drain: 发送完后是否在 idle_timeout 内继续发送队列中的新邮件，同步发送时为False
+        """
+        attempt = 0
+        attachments = dict()
+        with self.app.app_context():
+            while jobs:
+                try:
+                    with mail.connect() as connection:
+                        while jobs:
+                            self._send(connection, jobs[0], attachments)
+                            jobs.pop(0)
+                            attempt = 0
+                            if not jobs and drain and self.enabled and not self._stop.is_set():
+                                jobs = self._take(self.idle_timeout)
+                                attachments = dict()
+                except (smtplib.SMTPException, OSError) as e:
+                    attempt += 1
+                    if attempt > self.max_retries:
+                        job = jobs.pop(0)
+                        logger.error("邮件发送失败，已重试%s次: %s %s %s",
+                                     self.max_retries, job['subject'], job['recipients'], e)
+                        attempt = 0
+                    else:
+                        logger.warning("邮件发送失败，第%s次重试: %s", attempt, e)
+                        time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+
+    def _run(self):
+        while not self._stop.is_set():
+            jobs = self._take(self.idle_timeout)
+            if jobs:
+                self._deliver(jobs)
+
+    def flush(self):
+        """
+        立即发送队列中的所有邮件
+        """
+        jobs = list()
+        while True:
+            try:
+                jobs.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if jobs:
+            self._deliver(jobs, drain=False)
+
+    def shutdown(self, timeout=10):
+        """
+        停止后台线程并发送剩余邮件
+        """
+        self._stop.set()
+        if self._pid == os.getpid():
+            for thread in self._threads:
+                thread.join(timeout)
+        self.flush()
+
+
+mail_dispatcher = MailDispatcher()
+
+
+def send_email(subject, sender, recipients, html_body,
+               attachments=None):
+    mail_dispatcher.submit(subject, sender, recipients, html_body, attachments)
@@ -0,0 +1,141 @@
+import logging
+import time
+from datetime import datetime, date
+
+import xlsxwriter
+
+from app.models.model import User, Department, Operation
+from app.utils.core import db
+
+logger = logging.getLogger(__name__)
+
+
+def users_query():
+    return db.session.query(User.id, User.username, User.name, User.email, Department.name,
+                            User.member_since, User.last_seen) \
+        .outerjoin(Department, User.department_id == Department.id) \
+        .order_by(User.id)
+
+
+def departments_query():
+    return db.session.query(Department.id, Department.name, Department.describe, Department.active,
+                            Department.timestamp) \
+        .order_by(Department.id)
+
+
+def operations_query():
+    return db.session.query(Operation.id, User.username, Operation.describe, Operation.ip, Operation.timestamp) \
+        .outerjoin(User, Operation.operator_id == User.id) \
+        .order_by(Operation.id)
+
+
+# 可导出的数据表: (查询, 表头)
+EXPORTS = {
+    'users': (users_query, ['ID', '账号', '名字', '邮箱', '部门', '创建时间', '最后访问时间']),
+    'departments': (departments_query, ['ID', '名字', '描述', '是否启用', '创建时间']),
+    'operations': (operations_query, ['ID', '操作人', '操作描述', 'IP', '操作时间']),
+}
+
+
+def peak_rss_mb():
+    """
+    当前进程的峰值内存(MB)，Windows等没有 resource 模块的平台返回None
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def rss_mb():
+    """
+    当前进程的常驻内存(MB)，不支持时返回峰值内存
+    """
+    try:
+        import resource
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return round(pages * resource.getpagesize() / 1024 / 1024, 1)
+    except (ImportError, OSError, IndexError, ValueError):
+        return peak_rss_mb()
+
+
+class TableExport(object):
+    """
+    流式导出Excel
+    查询通过 yield_per 使用服务端游标分批读取，xlsxwriter 使用 constant_memory 模式逐行落盘，
+    内存占用与导出行数无关。超过单个sheet的行数上限时自动新建sheet。
+    """
+    # Excel单个sheet的最大行数
+    max_rows = 1048576
+    time_format = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, query, headers, chunk_size=1000, sheet_name='Sheet'):
+        self.query = query
+        self.headers = headers
+        self.chunk_size = chunk_size
+        self.sheet_name = sheet_name
+
+    def _add_sheet(self, workbook, bold, index):
+        worksheet = workbook.add_worksheet('{}{}'.format(self.sheet_name, index))
+        worksheet.write_row(0, 0, self.headers, bold)
+        return worksheet
+
+    def _cell(self, value):
+        if isinstance(value, datetime):
+            return value.strftime(self.time_format)
+        if isinstance(value, date):
+            return value.strftime('%Y-%m-%d')
+        return value
+
+    def write(self, path):
+        """
+        导出到指定路径
+        :param path: 文件路径
+        :return: 导出统计 行数、耗时、每秒行数、内存
+        """
+        start = time.monotonic()
+        rss_start = rss_mb()
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        bold = workbook.add_format({'bold': True})
+        sheets = 1
+        worksheet = self._add_sheet(workbook, bold, sheets)
+        row_num = 0
+        rows = 0
+        for row in self.query.yield_per(self.chunk_size):
+            row_num += 1
+            if row_num >= self.max_rows:
+                sheets += 1
+                worksheet = self._add_sheet(workbook, bold, sheets)
+                row_num = 1
+            worksheet.write_row(row_num, 0, [self._cell(value) for value in row])
+            rows += 1
+        workbook.close()
+
+        seconds = time.monotonic() - start
+        stats = {
+            'rows': rows,
+            'sheets': sheets,
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(rows / seconds, 1) if seconds else rows,
+            'rss_start_mb': rss_start,
+            'rss_end_mb': rss_mb(),
+            'rss_peak_mb': peak_rss_mb(),
+        }
+        logger.info("导出 %s 完成: %s", path, stats)
+        return stats
+
+
+def export_table(path, table, chunk_size=1000):
+    """
+    导出数据表
+    :param path: 文件路径
+    :param table: 数据表 users departments operations
+    :param chunk_size: 每批读取行数
+    :return: 导出统计
+    """
+    if table not in EXPORTS:
+        raise ValueError('不支持导出的数据表: {}'.format(table))
+    query, headers = EXPORTS[table]
+    return TableExport(query(), headers, chunk_size, sheet_name=table).write(path)
@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+
+from flask import current_app
+
+from app.utils.util import Redis
+
+
+class ReportJob(object):
+    """
+    报表异步任务
+    任务状态存放在Redis的hash表 report_job:<job_id> 中，由celery任务 render_report 生成报表。
+    只依赖模板等资源文件的报表按 (类型, 资源版本, 参数) 的哈希值作为任务ID和文件名，
+    文件已存在时直接返回；依赖数据库数据的报表每次生成新任务，相同请求通过去重键合并。
+    status: pending 等待中, running 生成中, done 完成, failed 失败
+    """
+    # 报表类型: 文件后缀
+    kinds = {'excel': 'xlsx', 'word': 'docx', 'pdf': 'pdf', 'pdf_sections': 'pdf', 'export': 'xlsx'}
+    # 报表用到的资源文件，修改后报表会重新生成；None表示报表内容依赖数据库，不缓存
+    assets = {
+        'excel': lambda config: [],
+        'word': lambda config: [os.path.join(config['REPORT_TEMPLATES'], 'test.docx'),
+                                os.path.join(config['REPORT_TEMPLATES'], 'test.jpg')],
+        'pdf': lambda config: [os.path.join(config['SIM_SUN'], 'SimSun.ttf'),
+                               os.path.join(config['REPORT_TEMPLATES'], 'test.jpg')],
+        'pdf_sections': lambda config: [os.path.join(config['SIM_SUN'], 'SimSun.ttf'),
+                                        os.path.join(config['REPORT_TEMPLATES'], 'test.jpg')],
+        'export': None,
+    }
+    # 客户端可以传入的报表参数，其余参数(如并发数、分块大小)只能由服务端配置
+    params = {'excel': (), 'word': (), 'pdf': (), 'pdf_sections': ('sections',), 'export': ('table',)}
+    # 可导出的数据表，与 app.utils.export.EXPORTS 一致，写在这里是为了不在web进程导入xlsxwriter
+    export_tables = ('users', 'departments', 'operations')
+    # pdf章节内容类型: 参数个数，见 app.api.report.section_flowables
+    section_blocks = {'paragraph': 1, 'table': 0, 'image': 0, 'page_break': 0}
+    max_sections = 50
+    max_blocks = 200
+    job_prefix = 'report_job:'
+    dedup_prefix = 'report_dedup:'
+    # 有权查看任务的用户ID集合，相同请求合并到同一任务时每个提交者都会加入
+    owner_prefix = 'report_owner:'
+
+    # KEYS: 去重键, 任务键
+    # ARGV: 任务ID, 去重键过期时间, 任务键前缀, 报表类型, 参数, 创建时间, 任务过期时间, 已完成的任务是否可复用
+    submit_script = """
+    local existing = redis.call('GET', KEYS[1])
+    if existing then
+        local status = redis.call('HGET', ARGV[3] .. existing, 'status')
+        if status and status ~= 'failed' and (status ~= 'done' or ARGV[8] == '1') then
+            return {existing, 0}
+        end
+    end
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    redis.call('DEL', KEYS[2])
+    redis.call('HMSET', KEYS[2], 'job_id', ARGV[1], 'kind', ARGV[4], 'params', ARGV[5],
+               'status', 'pending', 'progress', 0, 'created_at', ARGV[6])
+    redis.call('EXPIRE', KEYS[2], ARGV[7])
+    return {ARGV[1], 1}
+    """
+
+    @classmethod
+    def _key(cls, job_id):
+        return cls.job_prefix + job_id
+
+    @classmethod
+    def dedup_key(cls, kind, params):
+        raw = json.dumps([kind, params], sort_keys=True, ensure_ascii=False)
+        return cls.dedup_prefix + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def content_key(cls, kind, params):
+        """
+        报表内容的哈希值，报表依赖数据库数据时返回None
+        """
+        assets = cls.assets[kind]
+        if assets is None:
+            return None
+        config = current_app.config
+        version = [os.stat(path).st_mtime for path in assets(config)]
+        raw = json.dumps([kind, config.get('REPORT_CACHE_VERSION', 1), version, params],
+                         sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def report_path(cls, job_id, kind):
+        report_path = current_app.config.get("REPORT_PATH", "./report")
+        return os.path.join(report_path, "{}.{}".format(job_id, cls.kinds[kind]))
+
+    @classmethod
+    def validate(cls, kind, params):
+        """
+        校验客户端传入的报表参数
+        :param kind: 报表类型
+        :param params: 报表参数
+        :return: 错误信息，参数合法时返回None
+        """
+        if not isinstance(params, dict):
+            return 'Report params must be an object.'
+        unknown = sorted(set(params) - set(cls.params[kind]))
+        if unknown:
+            return 'Unknown report params: {}.'.format(', '.join(unknown))
+        if kind == 'export' and params.get('table') not in cls.export_tables:
+            return 'Unknown export table.'
+        if kind == 'pdf_sections' and 'sections' in params:
+            return cls._validate_sections(params['sections'])
+        return None
+
+    @classmethod
+    def _validate_sections(cls, sections):
+        if not isinstance(sections, list) or not 0 < len(sections) <= cls.max_sections:
+            return 'Sections must be a list of 1-{} items.'.format(cls.max_sections)
+        for section in sections:
+            if not isinstance(section, dict) or set(section) - {'title', 'blocks'}:
+                return 'Section must be an object with title and blocks.'
+            if not isinstance(section.get('title', ''), str):
+                return 'Section title must be a string.'
+            blocks = section.get('blocks')
+            if not isinstance(blocks, list) or len(blocks) > cls.max_blocks:
+                return 'Section blocks must be a list of at most {} items.'.format(cls.max_blocks)
+            for block in blocks:
+                if not isinstance(block, list) or not block or block[0] not in cls.section_blocks \
+                        or len(block) != cls.section_blocks[block[0]] + 1 \
+                        or not all(isinstance(arg, str) for arg in block[1:]):
+                    return 'Invalid section block.'
+        return None
+
+    @classmethod
+    def grant(cls, job_id, user_id):
+        """
+        允许用户查看任务及下载报表
+        """
+        with Redis.pipeline() as pipe:
+            pipe.sadd(cls.owner_prefix + job_id, user_id)
+            pipe.expire(cls.owner_prefix + job_id, current_app.config.get('REPORT_JOB_EXPIRE', 86400))
+            pipe.execute()
+
+    @classmethod
+    def owned_by(cls, job_id, user_id):
+        """
+        用户是否提交过该任务
+        """
+        return bool(Redis.sismember(cls.owner_prefix + job_id, user_id))
+
+    @classmethod
+    def submit(cls, kind, params=None, user_id=None):
+        """
+        提交报表任务，报表已生成时直接返回，相同请求的任务未失败时返回已有任务
+        :param kind: 报表类型
+        :param params: 报表参数
+        :param user_id: 提交用户，只有提交过的用户可以查看任务
+        :return: 任务信息
+        """
+        job = cls._submit(kind, params)
+        if user_id is not None:
+            cls.grant(job['job_id'], user_id)
+        return job
+
+    @classmethod
+    def _submit(cls, kind, params=None):
+        # 写在函数内是为了防止循环导入
+        from app.celery import render_report
+
+        params = params or dict()
+        config = current_app.config
+        digest = cls.content_key(kind, params)
+        if digest is None:
+            job_id = uuid.uuid4().hex
+            dedup_key = cls.dedup_key(kind, params)
+        else:
+            job_id = digest
+            dedup_key = cls.dedup_prefix + digest
+            path = cls.report_path(job_id, kind)
+            if os.path.exists(path):
+                # 命中缓存，刷新修改时间避免被清理
+                os.utime(path)
+                return cls.done(job_id, kind, params, path)
+
+        keys = [dedup_key, cls._key(job_id)]
+        args = [job_id,
+                config.get('REPORT_JOB_DEDUP_EXPIRE', 600),
+                cls.job_prefix,
+                kind,
+                json.dumps(params, ensure_ascii=False),
+                datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                config.get('REPORT_JOB_EXPIRE', 86400),
+                # 文件不存在(已被清理)时，已完成的缓存任务需要重新生成
+                0 if digest else 1]
+        job_id, created = Redis.eval_script(cls.submit_script, keys, args)
+        job_id = job_id.decode('utf-8')
+        if created:
+            render_report.delay(job_id)
+        return cls.get(job_id)
+
+    @classmethod
+    def done(cls, job_id, kind, params, path):
+        """
+        返回已生成报表的任务信息，任务状态已过期时重新写入
+        """
+        job = cls.get(job_id)
+        if job is None or job['status'] != 'done':
+            with Redis.pipeline() as pipe:
+                pipe.hmset(cls._key(job_id), dict(job_id=job_id, kind=kind, status='done', progress=100,
+                                                  params=json.dumps(params, ensure_ascii=False),
+                                                  path=path, url=path.lstrip(".")))
+                pipe.expire(cls._key(job_id), current_app.config.get('REPORT_JOB_EXPIRE', 86400))
+                pipe.execute()
+            job = cls.get(job_id)
+        return job
+
+    @classmethod
+    def get(cls, job_id):
+        """
+        获取任务信息，不存在时返回None
+        """
+        data = Redis.hgetall(cls._key(job_id))
+        if not data:
+            return None
+        job = {key.decode('utf-8'): value.decode('utf-8') for key, value in data.items()}
+        job['params'] = json.loads(job.get('params') or '{}')
+        job['progress'] = int(job.get('progress', 0))
+        return job
+
+    @classmethod
+    def update(cls, job_id, **fields):
+        """
+        更新任务状态
+        """
+        Redis.hmset(cls._key(job_id), fields)
+
+
+def evict_reports(report_path, max_bytes, max_age):
+    """
+    清理报表目录，先删除超过 max_age 秒未使用的文件，总大小仍超过 max_bytes 时按最久未使用依次删除
+    :param report_path: 报表目录
+    :param max_bytes: 目录最大字节数
+    :param max_age: 文件最长保留时间(秒)
+    :return: 删除的文件数
+    """
+    now = time.time()
+    files = list()
+    for entry in os.scandir(report_path):
+        # 正在生成的临时文件不清理
+        if entry.is_file() and not entry.name.endswith('.part'):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    for mtime, size, path in files:
+        if now - mtime <= max_age and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
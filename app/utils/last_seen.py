@@ -0,0 +1,91 @@
+import logging
+from datetime import datetime
+
+import redis
+from sqlalchemy import case
+
+from app.models.model import User
+from app.utils.cache import LRUCache
+from app.utils.core import db
+from app.utils.util import Redis
+
+logger = logging.getLogger(__name__)
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class LastSeenTracker(object):
+    """
+    用户最后访问时间记录
+    同一用户在 LAST_SEEN_GRANULARITY 秒内只记录一次访问。
+    开启 LAST_SEEN_WRITE_BEHIND 时访问记录先写入Redis，由定时任务 flush_last_seen
+    批量更新数据库；未开启时直接更新数据库。
+    """
+    key = 'last_seen'
+
+    def __init__(self, app=None):
+        self.granularity = 60
+        self.write_behind = False
+        self.batch_size = 500
+        self._touched = LRUCache(ttl=self.granularity)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.granularity = app.config.get('LAST_SEEN_GRANULARITY', 60)
+        self.write_behind = app.config.get('LAST_SEEN_WRITE_BEHIND', False)
+        self.batch_size = app.config.get('LAST_SEEN_BATCH_SIZE', 500)
+        self._touched = LRUCache(app.config.get('LAST_SEEN_LOCAL_SIZE', 10000), self.granularity)
+        if self.write_behind and not app.config.get('SCHEDULER_OPEN'):
+            logger.warning("已开启 LAST_SEEN_WRITE_BEHIND 但未开启定时任务，最后访问时间不会写入数据库")
+
+    def touch(self, user):
+        """
+        记录用户访问
+        :param user: 当前用户
+        :return:
+        """
+        if self._touched.get(user.id) is not None:
+            return
+        now = datetime.now()
+        self._touched.set(user.id, now)
+        if user.last_seen and (now - user.last_seen).total_seconds() < self.granularity:
+            return
+
+        if self.write_behind:
+            try:
+                Redis.hset(self.key, user.id, now.strftime(TIME_FORMAT))
+                return
+            except redis.RedisError as e:
+                logger.warning("记录访问时间失败，改为直接写入数据库: %s", e)
+        user.ping()
+        db.session.commit()
+
+    def flush(self):
+        """
+        将Redis中记录的访问时间批量写入数据库
+        :return: 更新的用户数
+        """
+        with Redis.pipeline() as pipe:
+            pipe.hgetall(self.key)
+            pipe.delete(self.key)
+            touches, _ = pipe.execute()
+        if not touches:
+            return 0
+
+        values = {int(user_id): datetime.strptime(value.decode('utf-8'), TIME_FORMAT)
+                  for user_id, value in touches.items()}
+        user_ids = list(values)
+        table = User.__table__
+        for start in range(0, len(user_ids), self.batch_size):
+            batch = {user_id: values[user_id] for user_id in user_ids[start:start + self.batch_size]}
+            # UPDATE users SET last_seen = CASE id WHEN ... THEN ... END WHERE id IN (...)
+            db.session.execute(
+                table.update()
+                    .where(table.c.id.in_(list(batch)))
+                    .values(last_seen=case(batch, value=table.c.id)))
+        db.session.commit()
+        return len(user_ids)
+
+
+last_seen_tracker = LastSeenTracker()
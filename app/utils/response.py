@@ -1,6 +1,47 @@
-from flask import request, current_app, jsonify
+import yaml
+from flask import request, current_app
 
 from app.utils.code import ResponseCode
+from app.utils.core import json_response
+
+
+class MessageTable(object):
+    """
+    响应消息表
+    启动时读取 RESPONSE_MESSAGE 文件，按 (语言, 响应编码) 建立一张查找表，
+    请求中只需一次字典查找。未知语言使用默认语言 LANG。
+    """
+
+    def __init__(self, app=None):
+        self.default_lang = "zh_CN"
+        self.languages = frozenset()
+        # (lang, code): msg
+        self._table = dict()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        with open(app.config['RESPONSE_MESSAGE'], 'r', encoding='utf-8') as f:
+            msg = yaml.safe_load(f.read())
+        # 保留原来按语言读取配置的方式
+        app.config.update(msg)
+        self.default_lang = app.config.get("LANG", "zh_CN")
+        self.languages = frozenset(msg)
+        self._table = {(lang, code): text for lang, codes in msg.items() for code, text in codes.items()}
+
+    def lang(self, lang):
+        """
+        请求的语言，不支持时返回默认语言
+        """
+        return lang if lang in self.languages else self.default_lang
+
+    def get(self, lang, code):
+        if not self._table:
+            return current_app.config[lang].get(code, None)
+        return self._table.get((lang, code))
+
+
+messages = MessageTable()
 
 
 class ResMsg(object):
@@ -10,11 +51,9 @@ class ResMsg(object):
 
     def __init__(self, data=None, code=ResponseCode.Success, rq=request):
         # 获取请求中语言选择,默认为中文
-        self.lang = rq.headers.get("lang",
-                                   current_app.config.get("LANG", "zh_CN")
-                                   )
+        self.lang = messages.lang(rq.headers.get("lang"))
         self._data = data
-        self._msg = current_app.config[self.lang].get(code, None)
+        self._msg = messages.get(self.lang, code)
         self._code = code
 
     def update(self, code=None, data=None, msg=None):
@@ -28,7 +67,7 @@ class ResMsg(object):
         if code is not None:
             self._code = code
             # 获取对应语言的响应消息
-            self._msg = current_app.config[self.lang].get(code, None)
+            self._msg = messages.get(self.lang, code)
         if data is not None:
             self._data = data
         if msg is not None:
@@ -45,13 +84,21 @@ class ResMsg(object):
             self.__dict__[name] = value
 
     @property
-    def data(self):
+    def body(self):
         """
-        输出响应文本内容
+        响应文本内容
         :return:
         """
-        body = self.__dict__
+        body = dict(self.__dict__)
         body["data"] = body.pop("_data")
         body["msg"] = body.pop("_msg")
         body["code"] = body.pop("_code")
-        return jsonify(body)
+        return body
+
+    @property
+    def data(self):
+        """
+        输出响应文本内容
+        :return:
+        """
+        return json_response(self.body)
@@ -0,0 +1,119 @@
+import logging
+
+from sqlalchemy import text, or_
+
+from app.models.model import User
+from app.utils.core import db
+
+logger = logging.getLogger(__name__)
+
+
+class UserSearch(object):
+    """
+    用户搜索，按用户账号和名字做子串匹配并按相关度排序
+    MySQL 使用 ngram 分词的 FULLTEXT 索引，SQLite 使用 FTS5 trigram 虚拟表(由触发器同步)，
+    关键字短于分词长度或其他数据库时退化为 LIKE。
+    索引通过 `flask search-index` 命令创建，索引尚未创建时同样退化为 LIKE。
+    """
+    mysql_index = 'ft_users_username_name'
+    # MySQL ngram_token_size 默认为2
+    mysql_min_length = 2
+    sqlite_table = 'users_fts'
+    sqlite_min_length = 3
+
+    sqlite_ddl = (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+        "username, name, content='users', content_rowid='id', tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN "
+        "INSERT INTO users_fts(rowid, username, name) VALUES (new.id, new.username, new.name); END",
+        "CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN "
+        "INSERT INTO users_fts(users_fts, rowid, username, name) "
+        "VALUES ('delete', old.id, old.username, old.name); END",
+        # 只在账号或名字修改时同步，last_seen 等字段的更新不重写索引；重建以替换旧版本的触发器
+        "DROP TRIGGER IF EXISTS users_fts_au",
+        "CREATE TRIGGER users_fts_au AFTER UPDATE OF username, name ON users BEGIN "
+        "INSERT INTO users_fts(users_fts, rowid, username, name) "
+        "VALUES ('delete', old.id, old.username, old.name); "
+        "INSERT INTO users_fts(rowid, username, name) VALUES (new.id, new.username, new.name); END",
+        "INSERT INTO users_fts(users_fts) VALUES ('rebuild')",
+    )
+
+    def __init__(self):
+        # 索引存在后不再检查；不存在时每次搜索都检查，创建索引后无需重启
+        self._index_ready = False
+
+    @staticmethod
+    def dialect():
+        return db.engine.dialect.name
+
+    def index_ready(self, dialect):
+        """
+        全文索引是否已创建
+        """
+        if self._index_ready:
+            return True
+        if dialect == 'mysql':
+            exists = db.session.execute(text(
+                "SELECT COUNT(*) FROM information_schema.statistics "
+                "WHERE table_schema = DATABASE() AND table_name = 'users' AND index_name = :name"),
+                {"name": self.mysql_index}).scalar()
+        else:
+            exists = db.session.execute(text(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {"name": self.sqlite_table}).scalar()
+        if not exists:
+            logger.warning("全文索引不存在，搜索使用 LIKE，请执行 flask search-index")
+        self._index_ready = bool(exists)
+        return self._index_ready
+
+    def create_index(self):
+        """
+        创建全文索引
+        """
+        dialect = self.dialect()
+        if dialect == 'mysql':
+            if not self.index_ready(dialect):
+                db.session.execute(text(
+                    "ALTER TABLE users ADD FULLTEXT INDEX {} (username, name) WITH PARSER ngram"
+                    .format(self.mysql_index)))
+        elif dialect == 'sqlite':
+            for statement in self.sqlite_ddl:
+                db.session.execute(text(statement))
+        else:
+            logger.warning("%s 不支持全文索引，搜索将使用 LIKE", dialect)
+        db.session.commit()
+
+    @staticmethod
+    def like(query, keyword):
+        pattern = "%" + keyword + "%"
+        return query.filter(or_(User.username.like(pattern), User.name.like(pattern)))
+
+    def apply(self, query, keyword):
+        """
+        在查询上加入搜索条件并按相关度排序
+        :param query: 用户查询
+        :param keyword: 关键字
+        :return: 新的查询
+        """
+        keyword = keyword.strip()
+        if not keyword:
+            return query
+        dialect = self.dialect()
+        if dialect == 'mysql' and len(keyword) >= self.mysql_min_length and self.index_ready(dialect):
+            # 短语匹配要求ngram连续出现，即子串匹配
+            phrase = '"{}"'.format(keyword.replace('"', ' '))
+            match = "MATCH (users.username, users.name) AGAINST ({} IN BOOLEAN MODE)"
+            return query.filter(text(match.format(':search_match')).bindparams(search_match=phrase)) \
+                .order_by(text(match.format(':search_rank') + ' DESC').bindparams(search_rank=phrase))
+        if dialect == 'sqlite' and len(keyword) >= self.sqlite_min_length and self.index_ready(dialect):
+            phrase = '"{}"'.format(keyword.replace('"', '""'))
+            matched = text("SELECT rowid AS id, rank FROM users_fts WHERE users_fts MATCH :search_match") \
+                .bindparams(search_match=phrase) \
+                .columns(id=db.Integer, rank=db.Float) \
+                .alias('users_fts_match')
+            # FTS5 的 rank 越小越相关
+            return query.join(matched, User.id == matched.c.id).order_by(matched.c.rank)
+        return self.like(query, keyword)
+
+
+user_search = UserSearch()
@@ -3,27 +3,74 @@ import io
 import random
 import re
 import string
+import time
+import uuid
 from functools import wraps
 
 import redis
-from PIL import Image, ImageFont, ImageDraw
 from flask import jsonify, current_app
 from app.utils.response import ResMsg
-from wechatpy.session.redisstorage import RedisStorage
-from wechatpy import WeChatClient
 import datetime
 
 class Redis(object):
     """
     redis数据库操作
+    所有操作共用 init_app 创建的进程内连接池
     """
+    _scripts = dict()
+
     @staticmethod
-    def _get_r():
-        host = current_app.config['REDIS_HOST']
-        port = current_app.config['REDIS_PORT']
-        db = current_app.config['REDIS_DB']
-        r = redis.Redis(host, port, db)
-        return r
+    def init_app(app):
+        """
+        创建连接池，挂在 app.extensions 上
+        fork出的子进程首次使用时redis-py会自动重建连接
+        """
+        pool = redis.ConnectionPool(
+            host=app.config['REDIS_HOST'],
+            port=app.config['REDIS_PORT'],
+            db=app.config['REDIS_DB'],
+            max_connections=app.config.get('REDIS_MAX_CONNECTIONS', 50),
+            socket_timeout=app.config.get('REDIS_SOCKET_TIMEOUT', 5),
+            socket_connect_timeout=app.config.get('REDIS_SOCKET_CONNECT_TIMEOUT', 2),
+            health_check_interval=app.config.get('REDIS_HEALTH_CHECK_INTERVAL', 30),
+            retry_on_timeout=True)
+        app.extensions['redis'] = pool
+        return pool
+
+    @classmethod
+    def _get_r(cls):
+        pool = current_app.extensions.get('redis')
+        if pool is None:
+            pool = cls.init_app(current_app)
+        return redis.Redis(connection_pool=pool)
+
+    @classmethod
+    def pipeline(cls, transaction=True):
+        """
+        获取管道，多条命令一次往返执行，transaction为True时使用MULTI/EXEC
+        with Redis.pipeline() as pipe:
+            pipe.hset(name, key, value)
+            pipe.expire(name, 60)
+            pipe.execute()
+        """
+        return cls._get_r().pipeline(transaction=transaction)
+
+    @classmethod
+    def transaction(cls, func, *watches, **kwargs):
+        """
+        WATCH指定的键后执行func(pipe)，键被修改时自动重试
+        """
+        return cls._get_r().transaction(func, *watches, **kwargs)
+
+    @classmethod
+    def eval_script(cls, script, keys=(), args=()):
+        """
+        执行lua脚本，脚本按内容缓存，使用EVALSHA一次往返执行
+        """
+        lua = cls._scripts.get(script)
+        if lua is None:
+            lua = cls._scripts[script] = cls._get_r().register_script(script)
+        return lua(keys=list(keys), args=list(args), client=cls._get_r())
 
     @classmethod
     def write(cls, key, value, expire=None):
@@ -98,6 +145,14 @@ class Redis(object):
         r = cls._get_r()
         r.hdel(name, key)
 
+    @classmethod
+    def incr(cls, name, amount=1):
+        """
+        自增并返回新值
+        """
+        r = cls._get_r()
+        return r.incr(name, amount)
+
     @classmethod
     def expire(cls, name, expire=None):
         """
@@ -110,6 +165,14 @@ class Redis(object):
         r = cls._get_r()
         r.expire(name, expire_in_seconds)
 
+    @classmethod
+    def sismember(cls, name, value):
+        """
+        判断是否为集合成员
+        """
+        r = cls._get_r()
+        return r.sismember(name, value)
+
 
 
 
@@ -133,11 +196,16 @@ def route(bp, *args, **kwargs):
         @wraps(f)
         def wrapper(*args, **kwargs):
             rv = f(*args, **kwargs)
+            # 响应函数返回已封装的响应，如 ResMsg().data
+            if isinstance(rv, current_app.response_class):
+                return rv
+            if isinstance(rv, tuple) and isinstance(rv[0], current_app.response_class):
+                return rv
             # 响应函数返回整数和浮点型
             if isinstance(rv, (int, float)):
                 res = ResMsg()
                 res.update(data=rv)
-                return jsonify(res.data)
+                return res.data
             # 响应函数返回元组
             elif isinstance(rv, tuple):
                 # 判断是否为多个参数
@@ -169,10 +237,14 @@ def view_route(f):
 
     def decorator(*args, **kwargs):
         rv = f(*args, **kwargs)
+        if isinstance(rv, current_app.response_class):
+            return rv
+        if isinstance(rv, tuple) and isinstance(rv[0], current_app.response_class):
+            return rv
         if isinstance(rv, (int, float)):
             res = ResMsg()
             res.update(data=rv)
-            return jsonify(res.data)
+            return res.data
         elif isinstance(rv, tuple):
             if len(rv) >= 3:
                 return jsonify(rv[0]), rv[1], rv[2]
@@ -198,6 +270,8 @@ class CaptchaTool(object):
     """
 
     def __init__(self, width=50, height=12):
+        # 写在函数内是为了只在生成验证码时才导入PIL
+        from PIL import Image, ImageFont, ImageDraw
 
         self.width = width
         self.height = height
@@ -238,10 +312,174 @@ class CaptchaTool(object):
         # im = self.im.filter(ImageFilter.GaussianBlur(radius=1.5))
         self.im = self.im.resize((100, 24))  # 重新设置大小
         buffered = io.BytesIO()
-        self.im.save(buffered, format="JPEG")
+        self.im.save(buffered, format="PNG")
         img_str = b"data:image/png;base64," + base64.b64encode(buffered.getvalue())
         return img_str, code
 
+    # 数字字形的像素坐标 {数字: (ys, xs)}，第一次批量生成时由默认字体栅格化
+    _atlas = None
+
+    @classmethod
+    def glyph_atlas(cls):
+        if cls._atlas is None:
+            import numpy as np
+            from PIL import Image, ImageFont, ImageDraw
+            font = ImageFont.load_default()
+            atlas = dict()
+            for digit in string.digits:
+                im = Image.new('L', (10, 12), 0)
+                ImageDraw.Draw(im).text((0, 0), text=digit, fill=255, font=font)
+                atlas[int(digit)] = np.nonzero(np.asarray(im) > 127)
+            cls._atlas = atlas
+        return cls._atlas
+
+    @classmethod
+    def render_batch(cls, count, lines=2, noise=0.03, width=50, height=12, scale=2):
+        """
+        批量生成验证码
+        在 (count, height, width, 3) 的numpy画布上一次绘制所有验证码: 字形取自预先栅格化的字形表，
+        按数字分组用坐标数组写入；干扰线和噪点也按批次向量化生成，每张图片只编码一次PNG。
+        未安装numpy时逐张生成。
+        :param count: 生成数量
+        :param lines: 每张图片的干扰线数量
+        :param noise: 噪点比例
+        :param width: 原始宽度，与 get_verify_code 相同
+        :param height: 原始高度
+        :param scale: 放大倍数
+        :return: [(图片, 答案), ...]
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            return [cls(width, height).get_verify_code() for _ in range(count)]
+        from PIL import Image
+
+        rng = np.random.default_rng()
+        canvas = np.full((count, height, width, 3), 255, dtype=np.uint8)
+        # 每张4个不重复的数字，与 random.sample(string.digits, 4) 相同
+        codes = np.argsort(rng.random((count, 10)), axis=1)[:, :4]
+        index = np.repeat(np.arange(count), 4)
+        digits = codes.ravel()
+        xs = 6 + rng.integers(-3, 4, count * 4) + 10 * np.tile(np.arange(4), count)
+        ys = 2 + rng.integers(-2, 3, count * 4)
+        colors = rng.integers(32, 128, (count * 4, 3), dtype=np.uint8)
+
+        for digit, (glyph_ys, glyph_xs) in cls.glyph_atlas().items():
+            selected = np.nonzero(digits == digit)[0]
+            if not len(selected):
+                continue
+            py = ys[selected, None] + glyph_ys[None, :]
+            px = xs[selected, None] + glyph_xs[None, :]
+            pi = np.broadcast_to(index[selected, None], py.shape)
+            pc = np.broadcast_to(colors[selected, None, :], py.shape + (3,))
+            valid = (py >= 0) & (py < height) & (px >= 0) & (px < width)
+            canvas[pi[valid], py[valid], px[valid]] = pc[valid]
+
+        if lines:
+            # 与 draw_lines 相同的端点范围，沿线段等距取点
+            n = count * lines
+            x1 = rng.integers(0, width // 2 + 1, n)
+            y1 = rng.integers(0, height // 2 + 1, n)
+            x2 = rng.integers(0, width + 1, n)
+            y2 = rng.integers(height // 2, height + 1, n)
+            t = np.linspace(0, 1, width)[None, :]
+            lx = np.rint(x1[:, None] + (x2 - x1)[:, None] * t).astype(np.intp).clip(0, width - 1)
+            ly = np.rint(y1[:, None] + (y2 - y1)[:, None] * t).astype(np.intp).clip(0, height - 1)
+            li = np.broadcast_to(np.repeat(np.arange(count), lines)[:, None], lx.shape)
+            canvas[li, ly, lx] = 0
+
+        # 最近邻放大，与 resize 的默认方式相同
+        canvas = canvas.repeat(scale, axis=1).repeat(scale, axis=2)
+        if noise:
+            dots = rng.random(canvas.shape[:3]) < noise
+            canvas[dots] = rng.integers(0, 256, (int(dots.sum()), 3), dtype=np.uint8)
+
+        result = list()
+        for i in range(count):
+            buffered = io.BytesIO()
+            Image.fromarray(canvas[i], "RGB").save(buffered, format="PNG", compress_level=1)
+            img_str = b"data:image/png;base64," + base64.b64encode(buffered.getvalue())
+            result.append((img_str, ''.join(str(digit) for digit in codes[i])))
+        return result
+
+
+class SmsCodeTool(object):
+    """
+    手机验证码签发
+    一个lua脚本原子地完成重复发送检查、按手机号和IP的滑动窗口限流以及验证码写入，
+    每次签发只需一次往返。验证码仍存放在以手机号为键的hash表的code字段中，
+    由 PhoneTool.check_phone_code 验证。
+    """
+    OK = 0
+    # 距离上次发送不足 SMS_RESEND_INTERVAL 秒
+    FREQUENT = 1
+    # 手机号在 SMS_LIMIT_WINDOW 秒内发送次数超过 SMS_PHONE_LIMIT
+    PHONE_LIMITED = 2
+    # IP在 SMS_LIMIT_WINDOW 秒内发送次数超过 SMS_IP_LIMIT
+    IP_LIMITED = 3
+
+    # KEYS: 验证码hash表, 手机号发送记录, IP发送记录
+    # ARGV: 验证码, 当前毫秒时间戳, 重发间隔(毫秒), 验证码有效期(秒), 限流窗口(毫秒), 手机号限额, IP限额, 本次记录ID
+    script = """
+    local now = tonumber(ARGV[2])
+    local window = tonumber(ARGV[5])
+    local send_at = redis.call('HGET', KEYS[1], 'send_at')
+    if send_at and now - tonumber(send_at) < tonumber(ARGV[3]) then
+        return 1
+    end
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], 0, now - window)
+    if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[6]) then
+        return 2
+    end
+    redis.call('ZREMRANGEBYSCORE', KEYS[3], 0, now - window)
+    if redis.call('ZCARD', KEYS[3]) >= tonumber(ARGV[7]) then
+        return 3
+    end
+    redis.call('HMSET', KEYS[1], 'code', ARGV[1], 'send_at', now)
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    redis.call('ZADD', KEYS[2], now, ARGV[8])
+    redis.call('PEXPIRE', KEYS[2], window)
+    redis.call('ZADD', KEYS[3], now, ARGV[8])
+    redis.call('PEXPIRE', KEYS[3], window)
+    return 0
+    """
+
+    @classmethod
+    def issue(cls, phone: str, ip: str, code: str) -> int:
+        """
+        签发验证码
+        :param phone: 已校验的手机号码
+        :param ip: 请求IP
+        :param code: 验证码
+        :return: (签发结果, 本次记录ID)，签发结果为OK表示成功，记录ID用于 revoke
+        """
+        config = current_app.config
+        now = int(time.time() * 1000)
+        record = "{}:{}".format(now, uuid.uuid4().hex)
+        keys = [phone, "sms:phone:{}".format(phone), "sms:ip:{}".format(ip)]
+        args = [code, now,
+                config.get('SMS_RESEND_INTERVAL', 60) * 1000,
+                config.get('SMS_CODE_EXPIRE', 180),
+                config.get('SMS_LIMIT_WINDOW', 3600) * 1000,
+                config.get('SMS_PHONE_LIMIT', 10),
+                config.get('SMS_IP_LIMIT', 30),
+                record]
+        return int(Redis.eval_script(cls.script, keys, args)), record
+
+    @staticmethod
+    def revoke(phone: str, ip: str, record: str):
+        """
+        作废验证码并撤销本次发送记录，短信发送失败时调用，不占用重发间隔和限流次数
+        :param phone: 手机号码
+        :param ip: 请求IP
+        :param record: issue 返回的记录ID
+        """
+        with Redis.pipeline() as pipe:
+            pipe.delete(phone)
+            pipe.zrem("sms:phone:{}".format(phone), record)
+            pipe.zrem("sms:ip:{}".format(ip), record)
+            pipe.execute()
+
 
 class PhoneTool(object):
     """
@@ -0,0 +1,44 @@
+"""
+图形验证码生成性能对比
+CaptchaTool: 逐张生成 CaptchaTool().get_verify_code()
+render_batch: CaptchaTool.render_batch(K)，numpy画布批量生成
+
+在项目根目录执行:
+    python benchmarks/bench_captcha.py --total 2000 --batch 1 16 64 256
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.utils.util import CaptchaTool  # noqa: E402
+
+
+def rate(func, total, batch):
+    start = time.perf_counter()
+    done = 0
+    while done < total:
+        func(batch)
+        done += batch
+    return done / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--total', type=int, default=2000, help='每种方式生成的数量')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 16, 64, 256], help='每批数量K')
+    args = parser.parse_args()
+
+    # 预先栅格化字形表，不计入耗时
+    CaptchaTool.glyph_atlas()
+    single = rate(lambda k: CaptchaTool().get_verify_code(), args.total, 1)
+    print("CaptchaTool            {:10.1f} 张/秒".format(single))
+    for batch in args.batch:
+        batched = rate(CaptchaTool.render_batch, args.total, batch)
+        print("render_batch K={:<7} {:10.1f} 张/秒  x{:.2f}".format(batch, batched, batched / single))
+
+
+if __name__ == '__main__':
+    main()
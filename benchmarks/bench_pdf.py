@@ -0,0 +1,65 @@
+"""
+pdf生成性能对比
+单线程: 所有章节放在一个文档中 multiBuild，与 pdf_write 的做法相同
+并行: pdf_write_parallel 按章节在进程池中生成后合并
+
+在项目根目录执行:
+    python benchmarks/bench_pdf.py --sections 100 --workers 1 2 4 8
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reportlab.platypus import PageBreak  # noqa: E402
+
+from app.api.report import pdf_doc, pdf_write, pdf_write_parallel, section_flowables  # noqa: E402
+from app.factory import create_app  # noqa: E402
+
+
+def make_sections(count):
+    sections = list()
+    for i in range(count):
+        sections.append({"title": "第{}章".format(i + 1),
+                         "blocks": [["paragraph", "章节{}".format(i + 1)], ["page_break"],
+                                    ["table"], ["page_break"], ["image"]]})
+    return sections
+
+
+def single_thread(path, sections):
+    data = list()
+    for section in sections:
+        data.extend(section_flowables(section))
+        data.append(PageBreak())
+    pdf_doc(path).multiBuild(data)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sections', type=int, default=50, help='章节数')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()], help='进程数')
+    args = parser.parse_args()
+
+    app = create_app(config_name="DEVELOPMENT")
+    sections = make_sections(args.sections)
+    with app.app_context(), tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'report.pdf')
+        print("pdf_write                     {:8.3f}s".format(timed(pdf_write, path)))
+        baseline = timed(single_thread, path, sections)
+        print("single thread  sections={:<5} {:8.3f}s".format(args.sections, baseline))
+        for workers in sorted(set(args.workers)):
+            seconds = timed(pdf_write_parallel, path, sections, workers=workers)
+            print("parallel       workers={:<5} {:8.3f}s  x{:.2f}".format(workers, seconds, baseline / seconds))
+
+
+if __name__ == '__main__':
+    main()
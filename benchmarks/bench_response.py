@@ -0,0 +1,65 @@
+"""
+响应序列化性能对比
+jsonify: 原来 ResMsg.data 使用的 flask jsonify(JSONEncoder)
+dumps: app.utils.core.dumps，安装orjson时使用orjson
+ResMsg: 完整的 ResMsg(data).data，包含消息查找和构造Response
+
+在项目根目录执行:
+    python benchmarks/bench_response.py --rows 1 10 100 1000 10000
+"""
+import argparse
+import decimal
+import os
+import sys
+import timeit
+import uuid
+from datetime import datetime, date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import jsonify  # noqa: E402
+
+from app.factory import create_app  # noqa: E402
+from app.utils.core import dumps, orjson  # noqa: E402
+from app.utils.response import ResMsg  # noqa: E402
+
+
+def make_payload(rows):
+    now = datetime.now()
+    return [{'id': i,
+             'name': '用户{}'.format(i),
+             'email': 'user{}@example.com'.format(i),
+             'member_since': now,
+             'birthday': date(1990, 1, 1),
+             'balance': decimal.Decimal('1234.56'),
+             'token': uuid.uuid4(),
+             'active': i % 2 == 0} for i in range(rows)]
+
+
+def per_call(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[1, 10, 100, 1000, 10000], help='每个响应的行数')
+    args = parser.parse_args()
+
+    app = create_app(config_name="DEVELOPMENT")
+    print("orjson: {}".format(orjson.__version__ if orjson else "未安装，使用json"))
+    print("{:>7} {:>10} {:>14} {:>14} {:>14} {:>8}".format(
+        'rows', 'bytes', 'jsonify(us)', 'dumps(us)', 'ResMsg(us)', 'x'))
+    with app.test_request_context(headers={'lang': 'zh_CN'}):
+        for rows in args.rows:
+            payload = make_payload(rows)
+            body = ResMsg(data=payload).body
+            number = max(1, 20000 // rows)
+            old = per_call(lambda: jsonify(body), number)
+            new = per_call(lambda: dumps(body), number)
+            full = per_call(lambda: ResMsg(data=payload).data, number)
+            print("{:>7} {:>10} {:>14.1f} {:>14.1f} {:>14.1f} {:>8.2f}".format(
+                rows, len(dumps(body)), old * 1e6, new * 1e6, full * 1e6, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+启动性能测试
+在新的python进程中以 -X importtime 执行 create_app，统计:
+  - create_app 冷启动耗时(包括导入)
+  - 启动后的常驻内存
+  - 已导入的重型依赖，报表/验证码等依赖应在首次使用时才导入
+  - 累计导入耗时最多的顶层包
+
+在项目根目录执行:
+    python benchmarks/startup.py --config PRODUCTION --runs 5 --top 15
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 只有部分接口或任务才需要的依赖
+HEAVY_MODULES = ['PIL', 'numpy', 'wechatpy', 'elasticsearch', 'xlsxwriter', 'docx', 'docxtpl',
+                 'reportlab', 'PyPDF2', 'aliyunsdkcore']
+
+# 统计时不能再导入 app.utils.export，它会导入 xlsxwriter，常驻内存直接读取 /proc/self/statm
+CHILD = """
+import json, os, sys, time
+start = time.perf_counter()
+from app.factory import create_app
+create_app(config_name={config!r})
+seconds = time.perf_counter() - start
+heavy = sorted(name for name in {heavy!r} if name in sys.modules)
+modules = len(sys.modules)
+try:
+    with open('/proc/self/statm') as f:
+        rss = round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024, 1)
+except (OSError, ValueError, AttributeError):
+    rss = None
+print(json.dumps({{'seconds': seconds, 'rss_mb': rss, 'heavy': heavy, 'modules': modules}}))
+"""
+
+# import time:       self [us] |  cumulative | imported package
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def run(config):
+    code = CHILD.format(config=config, heavy=HEAVY_MODULES)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode:
+        sys.stderr.write(proc.stderr)
+        raise SystemExit(proc.returncode)
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    # 顶层包的累计导入耗时(微秒)
+    packages = defaultdict(int)
+    for line in proc.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match and len(match.group(3)) == 1:
+            packages[match.group(4).split('.')[0]] += int(match.group(2))
+    result['packages'] = packages
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='PRODUCTION', help='配置名称')
+    parser.add_argument('--runs', type=int, default=5, help='运行次数')
+    parser.add_argument('--top', type=int, default=15, help='显示导入耗时最多的包数量')
+    args = parser.parse_args()
+
+    results = [run(args.config) for _ in range(args.runs)]
+    seconds = sorted(result['seconds'] for result in results)
+    rss = sorted(result['rss_mb'] for result in results if result['rss_mb'] is not None) or [None]
+    last = results[-1]
+    print("create_app 耗时  最小 {:.3f}s  中位数 {:.3f}s".format(seconds[0], seconds[len(seconds) // 2]))
+    print("常驻内存        中位数 {} MB".format(rss[len(rss) // 2]))
+    print("已导入模块数    {}".format(last['modules']))
+    print("已导入重型依赖  {}".format(', '.join(last['heavy']) or '无'))
+    print("\n导入耗时最多的顶层包(-X importtime 累计):")
+    packages = sorted(last['packages'].items(), key=lambda item: item[1], reverse=True)
+    for name, us in packages[:args.top]:
+        print("  {:<24} {:>8.1f} ms".format(name, us / 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from docx import Document
+from docx.shared import Mm
+from docxtpl import InlineImage
+
+from app.utils.assets import ReportAssets
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'word_templates')
+
+
+class ReportAssetsTemplateTest(unittest.TestCase):
+    """
+    word模板通过缓存连续渲染两次，与 word_write 的渲染内容相同
+    """
+
+    def render(self, assets, path):
+        doc = assets.template(os.path.join(TEMPLATES, 'test.docx'))
+        context = {
+            'title': "人员信息",
+            'table': [{"name": "小李", "age": 11}, {"name": "小张", "age": 21}],
+            'header': 'xxx公司人员信息管理',
+            'footer': '1',
+            'image': InlineImage(doc, assets.image(os.path.join(TEMPLATES, 'test.jpg')), height=Mm(10)),
+        }
+        doc.render(context)
+        doc.save(path)
+        return Document(path)
+
+    def test_render_twice(self):
+        assets = ReportAssets()
+        with tempfile.TemporaryDirectory() as tmp:
+            first = self.render(assets, os.path.join(tmp, 'first.docx'))
+            second = self.render(assets, os.path.join(tmp, 'second.docx'))
+        texts = ['\n'.join(p.text for p in document.paragraphs) for document in (first, second)]
+        self.assertIn('人员信息', texts[0])
+        self.assertEqual(texts[0], texts[1])
+        # 模板只读取一次
+        self.assertEqual(len(assets._templates), 1)
+
+    def test_template_is_fresh(self):
+        assets = ReportAssets()
+        path = os.path.join(TEMPLATES, 'test.docx')
+        self.assertIsNot(assets.template(path), assets.template(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from datetime import datetime
+
+from app.api.operation import legacy_range, time_range
+
+
+class LegacyRangeTest(unittest.TestCase):
+    """
+    旧参数 timestamp 转换的时间区间与原来的模糊匹配一致
+    """
+
+    def test_prefix(self):
+        cases = [
+            ('2020', datetime(2020, 1, 1), datetime(2021, 1, 1)),
+            ('2020-05', datetime(2020, 5, 1), datetime(2020, 6, 1)),
+            ('2020-12', datetime(2020, 12, 1), datetime(2021, 1, 1)),
+            ('2020-05-22', datetime(2020, 5, 22), datetime(2020, 5, 23)),
+            ('2020-05-22 10', datetime(2020, 5, 22, 10), datetime(2020, 5, 22, 11)),
+            ('2020-05-22 10:00', datetime(2020, 5, 22, 10), datetime(2020, 5, 22, 10, 1)),
+            ('2020-05-22 10:00:00', datetime(2020, 5, 22, 10), datetime(2020, 5, 22, 10, 0, 1)),
+        ]
+        for timestamp, start, end in cases:
+            with self.subTest(timestamp=timestamp):
+                self.assertEqual(legacy_range(timestamp), (start, end))
+
+    def test_like(self):
+        # 不补零、不是前缀或不是合法时间的写法继续使用模糊匹配
+        for timestamp in ['20', '2020-5', '2020-05-2', '2020-05-22 1', '2020-05-22 10:0',
+                          '05-22', '10:00', '2020-13', ' 2020-05', '2020/05/22']:
+            with self.subTest(timestamp=timestamp):
+                self.assertIsNone(legacy_range(timestamp))
+
+
+class TimeRangeTest(unittest.TestCase):
+
+    def test_range(self):
+        cases = [
+            (dict(), (None, None)),
+            (dict(date='2020-05-22'), (datetime(2020, 5, 22), datetime(2020, 5, 23))),
+            (dict(since='2020-05-22 10:00:00'), (datetime(2020, 5, 22, 10), None)),
+            (dict(until='2020-05-22'), (None, datetime(2020, 5, 23))),
+            (dict(until='2020-05-22 10:00:00'), (None, datetime(2020, 5, 22, 10))),
+            (dict(date='2020-05-22', since='2020-05-22 10:00:00', until='2020-05-25'),
+             (datetime(2020, 5, 22, 10), datetime(2020, 5, 23))),
+        ]
+        for kwargs, expected in cases:
+            with self.subTest(**kwargs):
+                self.assertEqual(time_range(**kwargs), expected)
+
+    def test_invalid(self):
+        for kwargs in [dict(date='2020-05'), dict(since='2020-05-22 10'), dict(until='yesterday')]:
+            with self.subTest(**kwargs):
+                self.assertRaises(ValueError, time_range, **kwargs)
+
+
+if __name__ == '__main__':
+    unittest.main()